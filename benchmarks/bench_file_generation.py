@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Compare local test-file generation strategies
+
+Every (method, filesize) combination runs in a fresh child process so that
+the reported peak RSS belongs to that combination only.
+
+    python benchmarks/bench_file_generation.py --sizes 16 256 1024
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+METHODS = ["urandom", "streaming"]
+
+
+def _run_urandom(file_path, filesize):
+    """
+    Generation as originally done in main()
+    """
+    from fts_datalake_test import MB
+    with open(file_path, 'wb') as fout:
+        fout.write(os.urandom(filesize * MB))
+
+
+def _run_streaming(file_path, filesize):
+    """
+    Chunked generation with on-the-fly checksums
+    """
+    from fts_datalake_test import _generate_file
+    _generate_file(file_path, filesize)
+
+
+def _child(method, filesize, directory):
+    """
+    Generate one file and print the measurements as JSON
+    """
+    # import before measuring so both methods pay the same start-up cost
+    import fts_datalake_test  # noqa: F401
+    file_path = os.path.join(directory,
+                             "bench_{}_{}mb".format(method, filesize))
+    start = time.time()
+    if method == "urandom":
+        _run_urandom(file_path, filesize)
+    else:
+        _run_streaming(file_path, filesize)
+    elapsed = time.time() - start
+    os.remove(file_path)
+    # ru_maxrss is reported in KB on Linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print(json.dumps({"seconds": elapsed, "peak_rss_mb": peak_mb}))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark local test-file generation")
+    parser.add_argument("--sizes",
+                        nargs="+",
+                        type=int,
+                        default=[16, 256, 1024],
+                        help="File sizes in MB")
+    parser.add_argument("--dir",
+                        default=None,
+                        help="Scratch directory (default: a temp dir)")
+    parser.add_argument("--child", nargs=2, help=argparse.SUPPRESS)
+    arg = parser.parse_args()
+
+    directory = arg.dir or tempfile.mkdtemp(prefix="fts_bench_")
+    if arg.child:
+        _child(arg.child[0], int(arg.child[1]), directory)
+        return
+
+    print("{:>10} {:>10} {:>10} {:>14}".format("method", "size(MB)", "MB/s",
+                                               "peak RSS(MB)"))
+    try:
+        for filesize in arg.sizes:
+            for method in METHODS:
+                out = subprocess.check_output([
+                    sys.executable,
+                    os.path.abspath(__file__), "--dir", directory, "--child",
+                    method,
+                    str(filesize)
+                ])
+                result = json.loads(out.decode().strip().splitlines()[-1])
+                print("{:>10} {:>10} {:>10.1f} {:>14.1f}".format(
+                    method, filesize, filesize / result["seconds"],
+                    result["peak_rss_mb"]))
+    finally:
+        if not arg.dir:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
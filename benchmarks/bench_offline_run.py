@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+"""
+Run fts_datalake_test.main() end-to-end without grid credentials
+
+Storage is the file-backed gfal2 stand-in in benchmarks/standins, FTS is the
+local mock server in mock_fts_server.py. Reports the time spent in every
+phase of the run and the number of storage operations and FTS requests
+needed for a full mesh of N endpoints.
+
+    python benchmarks/bench_offline_run.py --endpoints 8 --latency 0.02
+
+Arguments it does not know are passed on to the script, e.g. --processes 4
+(storage operations of worker processes are not counted then).
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "standins"))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, os.pardir))
+
+
+def _config(endpoints, filesizes, num_files, num_jobs):
+    return {
+        "num_of_files": num_files,
+        "testing_folder": "fts-testing",
+        "overwrite": False,
+        "checksum": "both",
+        "num_of_jobs": num_jobs,
+        "filesizes": filesizes,
+        "protocols": {
+            "davs": [
+                "se{:02d}.bench:443/store".format(i) for i in range(endpoints)
+            ]
+        },
+        "metadata": {
+            "activity": "benchmark"
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Offline end-to-end benchmark of fts_datalake_test.py")
+    parser.add_argument("--endpoints", type=int, default=6)
+    parser.add_argument("--filesizes", type=int, nargs="+", default=[1])
+    parser.add_argument("--num-files", type=int, nargs="+", default=[2])
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0.0,
+                        help="Seconds added to every storage operation")
+    parser.add_argument("--failing",
+                        type=int,
+                        default=0,
+                        help="Number of endpoints whose operations time out")
+    parser.add_argument("--fts-latency",
+                        type=float,
+                        default=1.0,
+                        help="Seconds before a transfer starts moving data")
+    parser.add_argument("--fts-throughput",
+                        type=float,
+                        default=100.0,
+                        help="Simulated MB/s of every transfer")
+    parser.add_argument("--poll-sleep", type=int, default=1)
+    parser.add_argument("--json",
+                        default=None,
+                        help="Also write the measurements to this file")
+    parser.add_argument("--keep",
+                        action="store_true",
+                        help="Keep the scratch directory")
+    arg, extra = parser.parse_known_args()
+
+    scratch = tempfile.mkdtemp(prefix="fts_bench_")
+    os.environ["GFAL2_STANDIN_ROOT"] = os.path.join(scratch, "store")
+    os.environ["FTS_LOCALPATH"] = os.path.join(scratch, "local")
+    os.environ["FTS_RESULTS_DB"] = os.path.join(scratch, "results.sqlite")
+    os.environ["FTS_CHECKPOINT"] = os.path.join(scratch, "checkpoint.json")
+    os.environ["FTS_SOURCE_POOL"] = os.path.join(scratch, "source-pool")
+    os.environ["FTS_POLL_SLEEP"] = str(arg.poll_sleep)
+    # what the poll scheduler would otherwise learn from past runs
+    os.environ.setdefault("FTS_JOB_OVERHEAD", str(arg.fts_latency))
+    os.environ.setdefault("FTS_POLL_DEFAULT_MBPS", str(arg.fts_throughput))
+    # keep the endpoint health of the real runs out of the benchmark
+    os.environ.setdefault("FTS_HEALTH_CACHE",
+                          os.path.join(scratch, "health.json"))
+    os.makedirs(os.environ["FTS_LOCALPATH"])
+
+    import gfal2
+    import mock_fts_server
+
+    config = _config(arg.endpoints, arg.filesizes, arg.num_files, arg.jobs)
+    gfal2.LATENCY = arg.latency
+    for endpoint in config["protocols"]["davs"]:
+        os.makedirs(gfal2.local_path("davs://" + endpoint))
+    gfal2.FAILING.update(
+        endpoint.split("/", 1)[0]
+        for endpoint in config["protocols"]["davs"][:arg.failing])
+    # worker processes of --processes N runs import the stand-ins as well
+    os.environ["PYTHONPATH"] = os.pathsep.join(
+        [os.path.join(HERE, "standins")] +
+        [path for path in [os.getenv("PYTHONPATH")] if path])
+    os.environ["GFAL2_STANDIN_LATENCY"] = str(arg.latency)
+    os.environ["GFAL2_STANDIN_FAILING"] = ",".join(gfal2.FAILING)
+
+    mock = mock_fts_server.MockFTS(arg.fts_latency, arg.fts_throughput)
+    server, endpoint = mock_fts_server.start(mock)
+    os.environ["FTS_ENDPOINT"] = endpoint
+
+    conf_file = os.path.join(scratch, "bench.json")
+    with open(conf_file, "w") as fout:
+        json.dump(config, fout)
+
+    import fts_datalake_test
+    sys.argv = [fts_datalake_test.__file__, "-i", conf_file] + extra
+    start = time.time()
+    try:
+        fts_datalake_test.main()
+    finally:
+        wall = time.time() - start
+        server.shutdown()
+        if not arg.keep:
+            shutil.rmtree(scratch)
+
+    measurements = {
+        "endpoints": arg.endpoints,
+        "wall_seconds": wall,
+        "phase_seconds": fts_datalake_test._phase_times,
+        "storage_operations": gfal2.OPERATIONS,
+        "fts_requests": mock.requests,
+        "fts_connections": mock.connections
+    }
+    print("")
+    print("wall clock: {:.2f}s for {} endpoints".format(wall, arg.endpoints))
+    print("phase seconds (summed over threads):")
+    for phase in fts_datalake_test.PHASES:
+        print("  {:<10} {:>8.2f}".format(phase,
+                                         fts_datalake_test._phase_times[phase]))
+    print("storage operations:")
+    for operation in sorted(gfal2.OPERATIONS):
+        print("  {:<10} {:>8}".format(operation, gfal2.OPERATIONS[operation]))
+    print("FTS requests:")
+    for route in sorted(mock.requests):
+        print("  {:<22} {:>8}".format(route, mock.requests[route]))
+    print("FTS connections: {}".format(mock.connections))
+    if arg.json:
+        with open(arg.json, "w") as fout:
+            json.dump(measurements, fout, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+Measure the startup cost of fts_datalake_test.py per CLI mode
+
+Every mode runs in fresh interpreters: the wall time of the whole command is
+the median over --repeat runs, and one extra run reports which parts of the
+transfer stack (gfal2, requests, fts3) the mode imported and the heaviest
+imports of the mode, timed by an __import__ hook (cumulative, i.e. with the
+modules they import in turn). Like the script, it needs python 2.
+
+The real gfal2/fts3 bindings are used when installed, the stand-ins in
+benchmarks/standins otherwise.
+
+    python benchmarks/bench_startup.py --repeat 10
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCRIPT = os.path.join(HERE, os.pardir, "fts_datalake_test.py")
+CONF = os.path.join(HERE, os.pardir, "conf", "datalake_all_1mb.json")
+STACK = ["gfal2", "requests", "fts3"]
+
+MODES = [
+    ("help", ["--help"]),
+    ("dry-run", ["-i", CONF, "--dry-run"]),
+    ("report", ["--report"]),
+]
+
+# runs main() with the given arguments, timing every first import, then
+# reports the loaded stack modules and the import times
+PROBE = """
+import sys, json, time, __builtin__
+_import = __builtin__.__import__
+_seconds = {{}}
+def _timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return _import(name, *args, **kwargs)
+    start = time.time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        _seconds[name] = _seconds.get(name, 0) + time.time() - start
+__builtin__.__import__ = _timed_import
+sys.argv = [{script!r}] + {args!r}
+sys.path.insert(0, {root!r})
+import fts_datalake_test
+try:
+    fts_datalake_test.main()
+except SystemExit:
+    pass
+sys.stdout.flush()
+sys.stderr.write(json.dumps({{
+    'stack': [name for name in {stack!r} if name in sys.modules],
+    'imports': _seconds
+}}) + "\\n")
+"""
+
+
+def _env(scratch):
+    env = dict(os.environ)
+    # stand-ins only as a fallback, after the real bindings
+    env["PYTHONPATH"] = os.pathsep.join(
+        [path for path in [os.getenv("PYTHONPATH")] if path] +
+        [os.path.join(HERE, "standins")])
+    env["FTS_RESULTS_DB"] = os.path.join(scratch, "results.sqlite")
+    return env
+
+
+def _wall(command, env, repeat):
+    times = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.call(command, env=env, stdout=devnull, stderr=devnull)
+            times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def _probe(args, env):
+    """
+    Stack modules loaded by a mode and {module: import seconds}
+    """
+    probe = PROBE.format(script=SCRIPT,
+                         args=args,
+                         root=os.path.join(HERE, os.pardir),
+                         stack=STACK)
+    process = subprocess.Popen([sys.executable, "-c", probe],
+                               env=env,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    _, err = process.communicate()
+    result = json.loads(err.strip().splitlines()[-1])
+    return result['stack'], result['imports']
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Startup time of fts_datalake_test.py per CLI mode")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8)
+    arg = parser.parse_args()
+    if sys.version_info[0] > 2:
+        sys.exit("fts_datalake_test.py needs python 2, "
+                 "run the benchmark with it")
+
+    import tempfile
+    import shutil
+    scratch = tempfile.mkdtemp(prefix="fts_startup_")
+    try:
+        env = _env(scratch)
+        baseline = _wall([sys.executable, "-c", "pass"], env, arg.repeat)
+        print("interpreter startup: {:.3f}s".format(baseline))
+        print("{:<10} {:>9}  {}".format("mode", "wall (s)", "transfer stack"))
+        imports = []
+        for name, args in MODES:
+            wall = _wall([sys.executable, SCRIPT] + args, env, arg.repeat)
+            stack, seconds = _probe(args, env)
+            print("{:<10} {:>9.3f}  {}".format(name, wall, ", ".join(stack) or
+                                               "not loaded"))
+            imports.append((name, seconds))
+
+        for name, seconds in imports:
+            print("heaviest imports of {} (cumulative ms):".format(name))
+            for module in sorted(seconds, key=seconds.get,
+                                 reverse=True)[:arg.top]:
+                print("  {:>8.1f} {}".format(1000 * seconds[module], module))
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    main()
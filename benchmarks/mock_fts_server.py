@@ -0,0 +1,211 @@
+"""
+Minimal local FTS REST server for the offline benchmarks
+
+Implements the calls used by fts_datalake_test.py: job submission, bulk job
+status and job file listing. Transfers "run" against the gfal2 stand-in
+store: a file finishes LATENCY + size / THROUGHPUT seconds after it was
+submitted, at which point it is copied to its destination (or fails if the
+source is missing or an endpoint is in the stand-in FAILING set).
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import gfal2
+
+MB = 1048576
+
+
+def _timestamp(epoch):
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(epoch))
+
+
+class MockFTS(object):
+    """
+    State of the mock server: jobs and per-route request counts
+    """
+
+    def __init__(self, latency=1.0, throughput=100.0):
+        self.latency = latency
+        # MB/s of every simulated transfer
+        self.throughput = throughput
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.requests = {}
+        self.connections = 0
+
+    def count(self, route):
+        with self.lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+    def count_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def submit(self, job):
+        job_id = str(uuid.uuid1())
+        now = time.time()
+        files = []
+        for transfer in job["files"]:
+            source = transfer["sources"][0]
+            path = gfal2.local_path(source)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            files.append({
+                "source_surl": source,
+                "dest_surl": transfer["destinations"][0],
+                "filesize": size,
+                "file_state": "SUBMITTED",
+                "reason": "",
+                "throughput": None,
+                "start_time": _timestamp(now),
+                "finish_time": None,
+                "file_metadata": transfer.get("metadata"),
+                "_due": now + self.latency + size / float(MB) / self.throughput
+            })
+        with self.lock:
+            self.jobs[job_id] = {
+                "job_id": job_id,
+                "job_metadata": job["params"].get("job_metadata"),
+                "submit_time": _timestamp(now),
+                "files": files
+            }
+        return job_id
+
+    def _advance(self, job):
+        now = time.time()
+        for file_map in job["files"]:
+            if file_map["finish_time"] or file_map["_due"] > now:
+                continue
+            endpoints = [
+                surl.split("://", 1)[1].split("/", 1)[0]
+                for surl in (file_map["source_surl"], file_map["dest_surl"])
+            ]
+            try:
+                if set(endpoints) & gfal2.FAILING:
+                    raise IOError("Connection timed out")
+                shutil.copyfile(gfal2.local_path(file_map["source_surl"]),
+                                gfal2.local_path(file_map["dest_surl"]))
+                file_map["file_state"] = "FINISHED"
+                file_map["throughput"] = self.throughput
+            except (IOError, OSError) as e:
+                file_map["file_state"] = "FAILED"
+                file_map["reason"] = str(e)
+            file_map["finish_time"] = _timestamp(now)
+
+    def status(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return {"job_id": job_id, "http_status": "404 Not Found"}
+            self._advance(job)
+            states = [file_map["file_state"] for file_map in job["files"]]
+        finished = all(state in ("FINISHED", "FAILED") for state in states)
+        if not finished:
+            job_state = "ACTIVE"
+        elif all(state == "FINISHED" for state in states):
+            job_state = "FINISHED"
+        elif "FINISHED" in states:
+            job_state = "FINISHEDDIRTY"
+        else:
+            job_state = "FAILED"
+        return {
+            "job_id": job_id,
+            "http_status": "200 Ok",
+            "job_state": job_state,
+            "job_finished": _timestamp(time.time()) if finished else None,
+            "job_metadata": job["job_metadata"],
+            "submit_time": job["submit_time"]
+        }
+
+    def files(self, job_id):
+        with self.lock:
+            job = self.jobs[job_id]
+            self._advance(job)
+            return [
+                dict((key, value)
+                     for key, value in file_map.items()
+                     if not key.startswith("_"))
+                for file_map in job["files"]
+            ]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, every response carries a Content-Length
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.mock.count_connection()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        mock = self.server.mock
+        parts = self.path.strip("/").split("/")
+        if parts[0] == "jobs" and len(parts) == 3 and parts[2] == "files":
+            mock.count("GET /jobs/<id>/files")
+            try:
+                self._reply(200, mock.files(parts[1]))
+            except KeyError:
+                self._reply(404, {"message": "No job " + parts[1]})
+        elif parts[0] == "jobs" and len(parts) == 2:
+            mock.count("GET /jobs/<ids>")
+            job_ids = parts[1].split(",")
+            statuses = [mock.status(job_id) for job_id in job_ids]
+            self._reply(200, statuses[0] if len(job_ids) == 1 else statuses)
+        elif parts[0] == "whoami":
+            mock.count("GET /whoami")
+            self._reply(200, {"delegation_id": "mock", "dn": ["/CN=mock"]})
+        else:
+            mock.count("GET other")
+            self._reply(404, {"message": "Not found"})
+
+    def do_POST(self):
+        mock = self.server.mock
+        if self.path.rstrip("/") != "/jobs":
+            mock.count("POST other")
+            self._reply(404, {"message": "Not found"})
+            return
+        mock.count("POST /jobs")
+        length = int(self.headers.get("Content-Length", 0))
+        job = json.loads(self.rfile.read(length).decode())
+        self._reply(200, {"job_id": mock.submit(job)})
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start(mock, host="127.0.0.1", port=0):
+    """
+    Serve mock in a background thread
+
+    Returns:
+        (server, endpoint URL)
+    """
+    server = _Server((host, port), _Handler)
+    server.mock = mock
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://{}:{}".format(host, server.server_address[1])
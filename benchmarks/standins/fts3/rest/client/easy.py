@@ -0,0 +1,84 @@
+"""
+Stand-in for fts3.rest.client.easy talking plain HTTP to mock_fts_server
+
+Only the calls used by fts_datalake_test.py are provided. No credentials are
+loaded and no proxy is delegated.
+"""
+
+import json
+
+try:
+    from urllib2 import Request, urlopen, HTTPError
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+
+from fts3.rest.client.exceptions import ClientError
+
+
+class Context(object):
+
+    def __init__(self, endpoint, verify=True, **kwargs):
+        self.endpoint = endpoint.rstrip("/")
+
+    def _request(self, method, path, body=None):
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+        request = Request(self.endpoint + path, data=data)
+        request.get_method = lambda: method
+        request.add_header("Content-Type", "application/json")
+        try:
+            return urlopen(request).read().decode()
+        except HTTPError as e:
+            raise ClientError("{} {}: {}".format(method, path, e))
+
+    def get(self, path):
+        return self._request("GET", path)
+
+    def post_json(self, path, body):
+        return self._request("POST", path, body)
+
+
+def new_transfer(source,
+                 destination,
+                 checksum=None,
+                 filesize=None,
+                 metadata=None,
+                 activity=None):
+    return {
+        "sources": [source],
+        "destinations": [destination],
+        "checksum": checksum,
+        "filesize": filesize,
+        "metadata": metadata,
+        "activity": activity
+    }
+
+
+def new_job(transfers=None, verify_checksum=True, overwrite=False,
+            timeout=None, metadata=None, **kwargs):
+    params = dict(kwargs)
+    params.update({
+        "verify_checksum": verify_checksum,
+        "overwrite": overwrite,
+        "timeout": timeout,
+        "job_metadata": metadata
+    })
+    return {"files": transfers or [], "params": params}
+
+
+def delegate(context, lifetime=None, force=False, **kwargs):
+    return "mock"
+
+
+def submit(context, job, **kwargs):
+    return json.loads(context.post_json("/jobs", job))["job_id"]
+
+
+def get_job_status(context, job_id, list_files=False):
+    status = json.loads(context.get("/jobs/" + job_id))
+    if list_files:
+        status["files"] = json.loads(context.get("/jobs/{}/files".format(
+            job_id)))
+    return status
@@ -0,0 +1,11 @@
+"""
+Stand-in for fts3.rest.client.exceptions
+"""
+
+
+class ClientError(Exception):
+    pass
+
+
+class ServerError(Exception):
+    pass
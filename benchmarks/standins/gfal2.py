@@ -0,0 +1,140 @@
+"""
+Stand-in for the gfal2 python bindings, backed by a local directory
+
+Every URL proto://host:port/path maps to STORE_ROOT/host_port/path, so all
+storage operations of fts_datalake_test.py run against the local disk.
+LATENCY seconds are added to every operation, and operations on hosts in
+FAILING raise a timeout error (after LATENCY). All operations are counted
+in OPERATIONS. LATENCY and FAILING can be set from the environment of
+worker processes (GFAL2_STANDIN_LATENCY, comma separated
+GFAL2_STANDIN_FAILING).
+"""
+
+import os
+import time
+import errno
+import shutil
+import threading
+
+STORE_ROOT = os.getenv("GFAL2_STANDIN_ROOT", "/tmp/gfal2-standin")
+LATENCY = float(os.getenv("GFAL2_STANDIN_LATENCY", 0.0))
+FAILING = set(
+    host for host in os.getenv("GFAL2_STANDIN_FAILING", "").split(",") if host)
+OPERATIONS = {}
+_lock = threading.Lock()
+
+
+class GError(Exception):
+
+    def __init__(self, message, code=errno.EIO):
+        Exception.__init__(self, message)
+        self.message = message
+        self.code = code
+
+
+def local_path(url):
+    """
+    Local path a gfal2 URL is stored at
+    """
+    if url.startswith("file://"):
+        return url[len("file://"):]
+    host, _, path = url.split("://", 1)[1].partition("/")
+    return os.path.join(STORE_ROOT, host.replace(":", "_"), path.lstrip("/"))
+
+
+def _operation(name, url):
+    with _lock:
+        OPERATIONS[name] = OPERATIONS.get(name, 0) + 1
+    if LATENCY:
+        time.sleep(LATENCY)
+    if not url.startswith("file://") and \
+            url.split("://", 1)[1].split("/", 1)[0] in FAILING:
+        raise GError("Connection timed out", errno.ETIMEDOUT)
+
+
+def _os_call(func, *args):
+    try:
+        return func(*args)
+    except (IOError, OSError) as e:
+        raise GError(str(e), e.errno or errno.EIO)
+
+
+class TransferParameters(object):
+
+    def __init__(self):
+        self.overwrite = False
+        self.checksum_check = False
+        self.timeout = 0
+        self.user_checksum = None
+
+    def set_user_defined_checksum(self, checksum_type, value):
+        self.user_checksum = (checksum_type, value)
+
+
+class Gfal2Context(object):
+
+    def __init__(self):
+        self.options = {}
+
+    def set_opt_integer(self, group, key, value):
+        self.options[(group, key)] = value
+
+    def set_opt_boolean(self, group, key, value):
+        self.options[(group, key)] = value
+
+    def set_opt_string(self, group, key, value):
+        self.options[(group, key)] = value
+
+    def transfer_parameters(self):
+        return TransferParameters()
+
+    def listdir(self, url):
+        _operation("listdir", url)
+        return _os_call(os.listdir, local_path(url))
+
+    def mkdir(self, url, mode):
+        _operation("mkdir", url)
+        return _os_call(os.mkdir, local_path(url), mode)
+
+    def lstat(self, url):
+        _operation("lstat", url)
+        return _os_call(os.lstat, local_path(url))
+
+    def stat(self, url):
+        _operation("stat", url)
+        return _os_call(os.stat, local_path(url))
+
+    def unlink(self, url):
+        if isinstance(url, list):
+            errors = []
+            for single in url:
+                try:
+                    self.unlink(single)
+                    errors.append(None)
+                except GError as e:
+                    errors.append(e)
+            return errors
+        _operation("unlink", url)
+        _os_call(os.unlink, local_path(url))
+        return 0
+
+    def filecopy(self, params, source, destination):
+        if isinstance(source, list):
+            errors = []
+            for single_source, single_destination in zip(source, destination):
+                try:
+                    self.filecopy(params, single_source, single_destination)
+                    errors.append(None)
+                except GError as e:
+                    errors.append(e)
+            return errors
+        _operation("filecopy", destination)
+        path = local_path(destination)
+        if os.path.exists(path) and not params.overwrite:
+            raise GError("File exists", errno.EEXIST)
+        _os_call(shutil.copyfile, local_path(source), path)
+        return 0
+
+
+def creat_context():
+    return Gfal2Context()
@@ -4,24 +4,82 @@ import os
 import re
 import sys
 import json
+import atexit
 import uuid
-import gfal2
 import time
 import errno
+import fcntl
+import shutil
+import zlib
+import math
+import random
+import hashlib
+import binascii
 import argparse
+import importlib
+import subprocess
 import logging
-import requests
+import logging.handlers
+import sqlite3
+import calendar
+import contextlib
+import threading
+import Queue
+import BaseHTTPServer
 import itertools
-import fts3.rest.client.easy as fts3
-import fts3.rest.client.exceptions as fts3_client_exceptions
-from datetime import datetime
+import heapq
+import functools
+import bisect
+from datetime import datetime, timedelta
+from collections import OrderedDict, namedtuple
+from multiprocessing.pool import ThreadPool
+
+
+class _LazyModule(object):
+    """
+    Module imported on first attribute access
+
+    Keeps the transfer stack (gfal2 and its plugins, requests, the fts3
+    client) out of the modes that never use it: --help, --dry-run,
+    --report, --merge-results, and FTS out of cleanup-only runs.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+gfal2 = _LazyModule("gfal2")
+requests = _LazyModule("requests")
+fts3 = _LazyModule("fts3.rest.client.easy")
+fts3_client_exceptions = _LazyModule("fts3.rest.client.exceptions")
 
 # CONFIG VARIABLES
 FILE_PREFIX = "fts.testfile"
-FTS_ENDPOINT = "https://fts3-pilot.cern.ch:8446"
+FTS_ENDPOINT = os.getenv("FTS_ENDPOINT", "https://fts3-pilot.cern.ch:8446")
 DEFAULT_LOCALPATH = "/tmp/ridona/temp_files_fts"
 LOCALPATH_TEMP_DIR = os.getenv("FTS_LOCALPATH", DEFAULT_LOCALPATH)
 MB = 1048576
+# size of the chunks written when generating local test files
+GENERATOR_CHUNK_SIZE = MB
+# number of chunks kept in the reusable random block pool
+GENERATOR_POOL_BLOCKS = 16
+# local payload cache that holds generated files for the whole run
+PAYLOAD_CACHE_DIR = os.path.join(LOCALPATH_TEMP_DIR, "payloads")
+PAYLOAD_CACHE_BUDGET = int(os.getenv("FTS_PAYLOAD_CACHE_MB", 10240)) * MB
+# log records buffered before they are written out
+LOG_BUFFER_RECORDS = int(os.getenv("FTS_LOG_BUFFER_RECORDS", 1000))
+# seconds between two writes of the log buffer
+LOG_FLUSH_INTERVAL = float(os.getenv("FTS_LOG_FLUSH_INTERVAL", 1))
+# expose metrics at http://<host>:FTS_METRICS_PORT/metrics during the run
+METRICS_PORT = int(os.getenv("FTS_METRICS_PORT", 0))
+# write metrics in the Prometheus text format to this file on exit
+METRICS_TEXTFILE = os.getenv("FTS_METRICS_TEXTFILE", "")
 
 # ------------------------------------------------------------------------------
 
@@ -32,39 +90,607 @@ logging.getLogger("gfal2").setLevel(logging.WARNING)
 logger = logging.getLogger()
 
 
+def _setup_logging():
+    """
+    Buffer log records instead of flushing the stream for every single one
+
+    The buffer is written when full, on warnings, every LOG_FLUSH_INTERVAL
+    seconds and at exit. Called by main(), so importing the module leaves
+    logging alone.
+    """
+    stream_handler = logger.handlers[0]
+    memory_handler = logging.handlers.MemoryHandler(LOG_BUFFER_RECORDS,
+                                                    logging.WARNING,
+                                                    stream_handler)
+    logger.removeHandler(stream_handler)
+    logger.addHandler(memory_handler)
+
+    def _flusher():
+        while True:
+            time.sleep(LOG_FLUSH_INTERVAL)
+            memory_handler.flush()
+
+    thread = threading.Thread(target=_flusher)
+    thread.daemon = True
+    thread.start()
+
+
 def _flush_logging_msg(msg):
     """
+    Log msg; it is written out by the next flush of the log buffer
     """
     logger.info(msg)
-    logger.handlers[0].flush()
+
+
+class _Metrics(object):
+    """
+    Thread-safe counters and histograms, rendered in the Prometheus text
+    exposition format
+    """
+
+    # upper bounds (seconds) of the latency histogram buckets
+    BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+               float("inf"))
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels) -> value
+        self.counters = {}
+        # (name, labels) -> [bucket counts..., sum, count]
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((labels or {}).items()))
+
+    def inc(self, name, labels=None, value=1):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.setdefault(
+                key, [0] * len(self.BUCKETS) + [0.0, 0])
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        labels = list(labels) + list(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(
+            '{}="{}"'.format(key, value) for key, value in labels) + "}"
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text format
+        """
+        lines = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, list(value)) for key, value in self.histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} counter".format(name))
+            lines.append("{}{} {}".format(name, self._labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {} histogram".format(name))
+            for bound, count in zip(self.BUCKETS, histogram):
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append("{}_bucket{} {}".format(
+                    name, self._labels(labels, [("le", le)]), count))
+            lines.append("{}_sum{} {}".format(name, self._labels(labels),
+                                              histogram[-2]))
+            lines.append("{}_count{} {}".format(name, self._labels(labels),
+                                                histogram[-1]))
+        return "\n".join(lines) + "\n"
+
+
+_metrics = _Metrics()
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = _metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve_metrics(port):
+    """
+    Serve the metrics on port in a background thread
+    """
+    server = BaseHTTPServer.HTTPServer(("", port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    _flush_logging_msg("Serving metrics on port {}".format(port))
+    return server
+
+
+def _write_metrics_textfile(path):
+    """
+    Atomically write the metrics for the node_exporter textfile collector
+    """
+    temp_path = "{}.{}".format(path, os.getpid())
+    with open(temp_path, "w") as fout:
+        fout.write(_metrics.render())
+    os.rename(temp_path, path)
+
+
+def _export_metrics():
+    """
+    Serve the metrics on FTS_METRICS_PORT and write them to
+    FTS_METRICS_TEXTFILE once the process exits, whichever way it does
+    """
+    if METRICS_PORT:
+        _serve_metrics(METRICS_PORT)
+    if METRICS_TEXTFILE:
+        atexit.register(_write_metrics_textfile, METRICS_TEXTFILE)
+
+
+PHASES = ["setup", "check", "generate", "upload", "submit", "poll", "purge"]
+_phase_lock = threading.Lock()
+# phase -> seconds spent in it, summed over all threads
+_phase_times = dict.fromkeys(PHASES, 0.0)
+
+
+@contextlib.contextmanager
+def _phase(name):
+    """
+    Account the time spent in the with-block to a phase of the run
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        with _phase_lock:
+            _phase_times[name] += elapsed
+        _metrics.inc("fts_datalake_phase_seconds_total", {'phase': name},
+                     elapsed)
+
+
+@contextlib.contextmanager
+def _fts_timed(operation):
+    """
+    Record latency and outcome of an FTS REST request
+    """
+    start = time.time()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        _metrics.observe("fts_datalake_fts_request_seconds",
+                         time.time() - start, {'operation': operation})
+        _metrics.inc("fts_datalake_fts_requests_total", {
+            'operation': operation,
+            'status': status
+        })
+
+
+def _log_phase_times():
+    _flush_logging_msg("Time spent per phase (summed over threads): {}".format(
+        ", ".join("{}={:.1f}s".format(phase, _phase_times[phase])
+                  for phase in PHASES)))
+
+
+# ------------------------------------------------------------------------------
+
+_generator_block_pool = []
+
+
+def _generator_blocks():
+    """
+    Lazily build the pool of random blocks used to assemble test files
+
+    The pool is filled once per process from a non-cryptographic PRNG, so
+    generating a file costs a memory copy per chunk instead of a call to
+    os.urandom for the whole file.
+
+    Returns:
+        list of GENERATOR_CHUNK_SIZE byte strings
+    """
+    if not _generator_block_pool:
+        rng = random.Random()
+        for _ in xrange(GENERATOR_POOL_BLOCKS):
+            bits = rng.getrandbits(GENERATOR_CHUNK_SIZE * 8)
+            block = binascii.unhexlify('%0*x' %
+                                       (GENERATOR_CHUNK_SIZE * 2, bits))
+            _generator_block_pool.append(block)
+    return _generator_block_pool
+
+
+def _generate_file(file_path, filesize, seed=None):
+    """
+    Write a random file in fixed-size chunks and checksum it on the fly
+
+    Every chunk is a block picked from the block pool by a PRNG seeded per
+    file, prefixed with the file token and the chunk index so that no two
+    chunks (or files) are identical. Peak memory stays at the size of the
+    block pool regardless of filesize.
+
+    Args:
+        file_path(str): Local path of the file to write
+        filesize(int): File size in MB
+        seed(int): Seed for the chunk order, random if None
+
+    Returns:
+        dict with the 'adler32' and 'md5' hex digests of the file
+    """
+    blocks = _generator_blocks()
+    rng = random.Random(seed)
+    token = '%016x' % rng.getrandbits(64)
+    adler32 = 1
+    md5 = hashlib.md5()
+    remaining = filesize * MB
+    index = 0
+    with open(file_path, 'wb') as fout:
+        while remaining > 0:
+            header = '{}{:016x}'.format(token, index)
+            block = blocks[rng.randrange(len(blocks))]
+            chunk = (header + block[len(header):])[:remaining]
+            fout.write(chunk)
+            adler32 = zlib.adler32(chunk, adler32)
+            md5.update(chunk)
+            remaining -= len(chunk)
+            index += 1
+    return {
+        'adler32': '{:08x}'.format(adler32 & 0xffffffff),
+        'md5': md5.hexdigest()
+    }
+
+
+class _PayloadCache(object):
+    """
+    Content-addressed cache of generated test files
+
+    Payloads are keyed by (filesize, seed) and stored under their MD5 digest.
+    They are generated on first use, kept for the whole run and handed out
+    as hardlinks, so every endpoint pair reuses the same local data. Least
+    recently used payloads are evicted once the total size exceeds budget.
+    """
+
+    def __init__(self,
+                 directory=PAYLOAD_CACHE_DIR,
+                 budget=PAYLOAD_CACHE_BUDGET):
+        self.directory = directory
+        self.budget = budget
+        self.total = 0
+        self.lock = threading.RLock()
+        # (filesize, seed) -> (path, digests), least recently used first
+        self.entries = OrderedDict()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, filesize, seed=None):
+        """
+        Return the payload for (filesize, seed), generating it if needed
+
+        Args:
+            filesize(int): File size in MB
+            seed(int): Seed of the payload content
+
+        Returns:
+            (path, digests) of the cached payload
+        """
+        key = (filesize, seed)
+        with self.lock:
+            if key in self.entries:
+                entry = self.entries.pop(key)
+                self.entries[key] = entry
+                return entry
+
+            self._evict(filesize * MB)
+            temp_path = os.path.join(self.directory,
+                                     "generating.{}".format(uuid.uuid1()))
+            digests = _generate_file(temp_path, filesize, seed)
+            path = os.path.join(self.directory, digests['md5'])
+            os.rename(temp_path, path)
+            self.entries[key] = (path, digests)
+            self.total += filesize * MB
+            return self.entries[key]
+
+    def link(self, filesize, seed, file_path):
+        """
+        Make a payload available under a unique local file path
+
+        Args:
+            filesize(int): File size in MB
+            seed(int): Seed of the payload content
+            file_path(str): Local path to hardlink the payload to
+
+        Returns:
+            digests of the payload
+        """
+        with self.lock:
+            path, digests = self.get(filesize, seed)
+            try:
+                os.link(path, file_path)
+            except OSError:
+                # e.g. file_path on another filesystem
+                shutil.copyfile(path, file_path)
+            return digests
+
+    def clear(self):
+        """
+        Remove all cached payloads
+        """
+        with self.lock:
+            while self.entries:
+                self._remove_oldest()
+
+    def _evict(self, size):
+        while self.entries and self.total + size > self.budget:
+            self._remove_oldest()
+
+    def _remove_oldest(self):
+        (filesize, _), (path, _) = self.entries.popitem(last=False)
+        self.total -= filesize * MB
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 
 # ------------------------------------------------------------------------------
 
 # gfal2 context
 GFAL2_TIMEOUT = os.getenv("GFAL2_TIMEOUT", 300)
-ctx = gfal2.creat_context()
-# GridFTP timeout
-ctx.set_opt_integer("GRIDFTP PLUGIN", "OPERATION_TIMEOUT", int(GFAL2_TIMEOUT))
-# HTTP timeout
-ctx.set_opt_integer("HTTP PLUGIN", "OPERATION_TIMEOUT", int(GFAL2_TIMEOUT))
+# number of endpoints set up concurrently
+GFAL2_SETUP_WORKERS = int(os.getenv("GFAL2_SETUP_WORKERS", 8))
+# seconds an endpoint may spend in setup before it is considered problematic
+GFAL2_SETUP_DEADLINE = int(
+    os.getenv("GFAL2_SETUP_DEADLINE", 2 * int(GFAL2_TIMEOUT)))
+
+# concurrent copies per destination directory
+GFAL2_UPLOAD_WORKERS = int(os.getenv("GFAL2_UPLOAD_WORKERS", 4))
+# retries of an individual file that failed to upload
+GFAL2_UPLOAD_RETRIES = int(os.getenv("GFAL2_UPLOAD_RETRIES", 2))
+# use the bulk form of gfal2 filecopy instead of concurrent single copies
+GFAL2_UPLOAD_BULK = os.getenv("GFAL2_UPLOAD_BULK", "0") == "1"
+# concurrent unlink/lstat operations per directory
+GFAL2_DELETE_WORKERS = int(os.getenv("GFAL2_DELETE_WORKERS", 8))
+# protocols whose gfal2 plugin deletes a list of files in one bulk request
+GFAL2_BULK_UNLINK_PROTOCOLS = os.getenv("GFAL2_BULK_UNLINK_PROTOCOLS",
+                                        "srm,davs,https").split(",")
+# destination directories purged at once
+GFAL2_PURGE_DIRS = int(os.getenv("GFAL2_PURGE_DIRS", 4))
+# seconds finished jobs are collected before their files are purged together
+GFAL2_PURGE_INTERVAL = float(os.getenv("GFAL2_PURGE_INTERVAL", 30))
+# gfal2 contexts shared by all storage operations
+GFAL2_CONTEXTS = int(os.getenv("GFAL2_CONTEXTS", 32))
+# file keeping the endpoint health between runs, empty to disable
+HEALTH_CACHE = os.getenv(
+    "FTS_HEALTH_CACHE",
+    os.path.join(os.path.expanduser("~"), ".fts-datalake", "health.json"))
+# seconds after which the failure score of an endpoint has halved
+HEALTH_HALF_LIFE = float(os.getenv("FTS_HEALTH_HALF_LIFE", 6 * 3600))
+# failure score above which an endpoint is only probed before being used
+HEALTH_OPEN_SCORE = float(os.getenv("FTS_HEALTH_OPEN_SCORE", 0.4))
+# timeout (seconds) of the probe of a known bad endpoint
+HEALTH_PROBE_TIMEOUT = int(os.getenv("FTS_HEALTH_PROBE_TIMEOUT", 15))
+# seconds a cached directory listing stays valid, 0 for the whole run
+GFAL2_LISTING_TTL = int(os.getenv("GFAL2_LISTING_TTL", 0))
+
+
+def _gfal_new_context(timeout=GFAL2_TIMEOUT):
+    """
+    Create a gfal2 context with the plugin timeouts set
+
+    Args:
+        timeout(int): Operation timeout in seconds
+
+    Returns:
+        gfal2 context
+    """
+    context = gfal2.creat_context()
+    # GridFTP timeout
+    context.set_opt_integer("GRIDFTP PLUGIN", "OPERATION_TIMEOUT", int(timeout))
+    # HTTP timeout
+    context.set_opt_integer("HTTP PLUGIN", "OPERATION_TIMEOUT", int(timeout))
+    return context
+
+
+class _GfalContextPool(object):
+    """
+    Bounded pool of gfal2 contexts shared by all threads
+
+    gfal2 contexts must not be shared between concurrently running
+    operations: an operation borrows a context for its duration. Contexts
+    are created on demand, each with its own plugin options, up to size;
+    beyond that operations wait for a context to be returned. Contexts are
+    reused most recently returned first, so short-lived worker threads no
+    longer pay the context setup.
+    """
+
+    def __init__(self, size=GFAL2_CONTEXTS, timeout=GFAL2_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.created = 0
+        self.idle = Queue.LifoQueue()
+
+    @contextlib.contextmanager
+    def context(self):
+        context = self._acquire()
+        try:
+            yield context
+        finally:
+            self.idle.put(context)
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if not create:
+            return self.idle.get()
+        try:
+            return _gfal_new_context(self.timeout)
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+
+
+_gfal_contexts = _GfalContextPool()
+# short-timeout contexts of the endpoint health probes
+_gfal_probe_contexts = _GfalContextPool(GFAL2_SETUP_WORKERS,
+                                        HEALTH_PROBE_TIMEOUT)
+
+
+def _gfal_endpoint(url):
+    """
+    Return the host[:port] part of a gfal2 URL
+    """
+    return url.split("://", 1)[1].split("/", 1)[0]
+
+
+def _gfal_op(op, *args, **kwargs):
+    """
+    Run a gfal2 operation with a context borrowed from the pool
+
+    Latency and outcome are recorded per operation, endpoint and protocol.
+    The URL labelling the operation is the destination for filecopy and
+    the first argument otherwise (the first element for bulk calls).
+
+    Args:
+        op(str): Name of the gfal2 context method (listdir, lstat, ...)
+        args: Arguments of the method
+        contexts(_GfalContextPool): Pool to borrow the context from
+    """
+    contexts = kwargs.get('contexts', _gfal_contexts)
+    url = args[2] if op == "filecopy" else args[0]
+    if isinstance(url, list):
+        url = url[0]
+    labels = {
+        'op': op,
+        'endpoint': _gfal_endpoint(url),
+        'protocol': url.split("://", 1)[0]
+    }
+    start = time.time()
+    status = "error"
+    try:
+        with contexts.context() as context:
+            result = getattr(context, op)(*args)
+        status = "ok"
+        return result
+    finally:
+        _metrics.observe("fts_datalake_gfal_operation_seconds",
+                         time.time() - start, labels)
+        labels['status'] = status
+        _metrics.inc("fts_datalake_gfal_operations_total", labels)
+
+
+def _gfal_unlink_one(url):
+    """
+    Unlink a single file with a gfal2 context borrowed from the pool
+
+    Returns:
+        None if successful, the error otherwise
+    """
+    try:
+        error = _gfal_op("unlink", str(url))
+    except Exception as e:
+        error = e
+    return error or None
+
+
+def _gfal_unlink_files(urls, workers=GFAL2_DELETE_WORKERS):
+    """
+    Unlink files, in bulk where the protocol supports it
+
+    Files of a protocol listed in GFAL2_BULK_UNLINK_PROTOCOLS are removed by
+    a single bulk gfal2 unlink call; the rest (and everything if the bulk
+    call itself fails) by a pool of up to workers concurrent unlinks.
+
+    Args:
+        urls(list): List of file URLs
+        workers(int): Number of concurrent unlinks
+
+    Returns:
+        Tuple with the number of deleted and failed files
+    """
+    if not urls:
+        return 0, 0
+
+    errors = None
+    if urls[0].split("://", 1)[0] in GFAL2_BULK_UNLINK_PROTOCOLS and \
+            len(urls) > 1:
+        try:
+            errors = _gfal_op("unlink", [str(url) for url in urls])
+        except Exception as e:
+            _flush_logging_msg("gfal-rm bulk failed:{}, falling back".format(e))
+    if errors is None:
+        pool = ThreadPool(max(1, min(workers, len(urls))))
+        try:
+            errors = pool.map(_gfal_unlink_one, urls)
+        finally:
+            pool.close()
+
+    failed = 0
+    for url, error in zip(urls, errors):
+        if error:
+            failed += 1
+            _flush_logging_msg("gfal-rm failed:{}, gfal_file:{}".format(
+                error, url))
+    return len(urls) - failed, failed
+
+
+def _gfal_mtime(url):
+    """
+    Return the modification time of a file, None if it cannot be stat-ed
+    """
+    try:
+        return _gfal_op("lstat", str(url)).st_mtime
+    except Exception as e:
+        _flush_logging_msg("gfal-stat failed:{}, gfal_file:{}".format(e, url))
+        return None
 
 
-def _gfal_clean_up_dir(directory, hours=24):
+def _gfal_clean_up_dir(directory, hours=24, workers=GFAL2_DELETE_WORKERS):
     """
-    Remove all files from a directory
+    Remove all files older than hours from a directory
 
     Args:
         directory(str): Directory path
+        hours(int): Minimum age of the files to remove
+        workers(int): Number of concurrent lstat/unlink operations
 
     Returns:
         None if successful
         -1 if error
     """
-
     _flush_logging_msg('gfal-ls {}'.format(directory))
     try:
-        filenames = ctx.listdir(str(directory))
+        filenames = _gfal_op("listdir", str(directory))
     except Exception as e:
         _flush_logging_msg("gfal-ls failed:{}, endpoint:{}".format(
             e, directory))
@@ -73,24 +699,22 @@ def _gfal_clean_up_dir(directory, hours=24):
     if filenames:
         _flush_logging_msg('gfal-ls (x{}) {}'.format(len(filenames), directory))
 
-        actually_deleted = 0
-        for file in filenames:
-            gfal_file = os.path.join(directory, file)
-            try:
-                info = ctx.lstat(str(gfal_file))
-                file_time = datetime.fromtimestamp(info.st_mtime)
-                now = datetime.now()
-                diff_time = now - file_time
-                if diff_time.seconds / 60 / 60 > hours:
-                    error = ctx.unlink(str(gfal_file))
-                    if not error:
-                        actually_deleted += 1
-                    else:
-                        _flush_logging_msg("error:{}").format(error)
-            except Exception as e:
-                _flush_logging_msg("gfal-rm failed:{}, gfal_file:{}".format(
-                    e, gfal_file))
+        urls = [os.path.join(directory, file) for file in filenames]
+        pool = ThreadPool(max(1, min(workers, len(urls))))
+        try:
+            mtimes = pool.map(_gfal_mtime, urls)
+        finally:
+            pool.close()
+
+        now = datetime.now()
+        expired = []
+        for url, mtime in zip(urls, mtimes):
+            if mtime is None:
                 continue
+            diff_time = now - datetime.fromtimestamp(mtime)
+            if diff_time.total_seconds() / 60 / 60 > hours:
+                expired.append(url)
+        actually_deleted, _ = _gfal_unlink_files(expired, workers)
 
         _flush_logging_msg('gfal-rm (x{} | hours={}) {}'.format(
             actually_deleted, hours, directory))
@@ -106,45 +730,257 @@ def _gfal_rm_files(filenames, directory):
         directory(str): Directory path
 
     Returns:
-        None if successful
-        -1 if error
+        Tuple with the number of deleted and failed files
     """
-
     _flush_logging_msg('gfal-rm (x{}) {}'.format(len(filenames), directory))
-    for file in filenames:
-        gfal_file = os.path.join(directory, file)
+    return _gfal_unlink_files(
+        [os.path.join(directory, file) for file in filenames])
+
+
+class _Deleter(object):
+    """
+    Purge planner removing queued files per directory in a background thread
+
+    Args:
+        interval(float): Seconds queued files are merged before a purge
+        dirs(int): Number of directories purged concurrently
+    """
+
+    def __init__(self, interval=GFAL2_PURGE_INTERVAL, dirs=GFAL2_PURGE_DIRS):
+        self.interval = interval
+        self.dirs = dirs
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        # endpoint -> {'deleted', 'failed', 'missing': int, 'seconds': float}
+        self.stats = {}
+        # directory -> files removed but not seen gone yet
+        self.unverified = {}
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, purge, done=None):
+        """
+        Queue the removal of files
+
+        Args:
+            purge(dict): {directory: filenames} to remove
+            done(callable): Called once all of the directories are purged
+        """
+        if not any(purge.values()):
+            if done:
+                done()
+            return
+        self.queue.put((purge, done))
+
+    def close(self):
+        """
+        Wait for the queued deletions, log and return the per-endpoint stats
+        """
+        self.queue.put(None)
+        self.thread.join()
+        for endpoint in sorted(self.stats):
+            stats = self.stats[endpoint]
+            _flush_logging_msg(
+                'gfal-rm summary {}: deleted:{} failed:{} missing:{} in '
+                '{:.1f}s'.format(endpoint, stats['deleted'], stats['failed'],
+                                 stats['missing'], stats['seconds']))
+        return self.stats
+
+    def _run(self):
+        pending = OrderedDict()
+        callbacks = []
+        purge_at = None
+        while True:
+            try:
+                if purge_at is None:
+                    item = self.queue.get()
+                else:
+                    item = self.queue.get(timeout=max(0.01, purge_at -
+                                                      time.time()))
+            except Queue.Empty:
+                item = False
+            if item:
+                purge, done = item
+                for directory, filenames in purge.items():
+                    pending.setdefault(directory, set()).update(filenames)
+                if done:
+                    callbacks.append(done)
+                if purge_at is None:
+                    purge_at = time.time() + self.interval
+                if time.time() < purge_at:
+                    continue
+            if pending:
+                self._purge(pending)
+                for done in callbacks:
+                    done()
+                pending = OrderedDict()
+                callbacks = []
+                purge_at = None
+            if item is None:
+                break
+        # last listing, only to verify the last round
+        if self.unverified:
+            self._purge({})
+
+    def _purge(self, pending):
+        for directory in self.unverified:
+            pending.setdefault(directory, set())
+        pool = ThreadPool(max(1, min(self.dirs, len(pending))))
         try:
-            error = ctx.unlink(str(gfal_file))
-            if not error:
-                pass
+            pool.map(lambda item: self._purge_directory(*item),
+                     sorted(pending.items()))
+        finally:
+            pool.close()
+
+    def _purge_directory(self, directory, filenames):
+        start = time.time()
+        with self.lock:
+            unverified = self.unverified.pop(directory, set())
+        with _phase("purge"):
+            try:
+                listing = set(_gfal_op("listdir", str(directory)))
+            except Exception as e:
+                # unreachable, left to the cleanup of a later setup
+                _flush_logging_msg("gfal-ls failed:{}, dir:{}".format(
+                    e, directory))
+                listing = set()
+                failed = len(filenames)
+                filenames = set()
             else:
-                _flush_logging_msg("error:{}").format(error)
-        except Exception as e:
-            _flush_logging_msg("gfal-rm failed:{}, gfal_file:{}".format(
-                e, gfal_file))
-            continue
-    return None
+                failed = 0
+            # removed last round but still there: retried once
+            lingering = unverified & listing
+            missing = filenames - listing
+            filenames = (filenames & listing) | lingering
+            deleted = 0
+            if filenames:
+                deleted, failed = _gfal_rm_files(sorted(filenames), directory)
+        for filename in lingering:
+            _flush_logging_msg("gfal-rm not effective, gfal_file:{}".format(
+                os.path.join(directory, filename)))
+        with self.lock:
+            if filenames - lingering:
+                self.unverified[directory] = filenames - lingering
+            stats = self.stats.setdefault(_gfal_endpoint(directory), {
+                'deleted': 0,
+                'failed': 0,
+                'missing': 0,
+                'seconds': 0.0
+            })
+            # lingering files were counted as deleted the round before
+            stats['deleted'] += deleted - len(lingering)
+            stats['failed'] += failed + len(lingering)
+            stats['missing'] += len(missing)
+            stats['seconds'] += time.time() - start
+
+
+def _gfal_transfer_params(overwrite=False, checksum=None):
+    """
+    Create gfal2 transfer parameters for an upload
+
+    Args:
+        overwrite(bool): Overwrite an existing destination file
+        checksum(str): Expected ADLER32 checksum (optional)
+
+    Returns:
+        gfal2 transfer parameters
+    """
+    with _gfal_contexts.context() as context:
+        params = context.transfer_parameters()
+    params.overwrite = overwrite
+    params.checksum_check = True
+    if checksum:
+        params.set_user_defined_checksum("ADLER32", checksum)
+    return params
+
+
+def _gfal_upload_result(src, dst, error, seconds, size):
+    """
+    Per-file upload result as returned by _gfal_upload_files
+    """
+    return {
+        'source': src,
+        'destination': dst,
+        'filename': os.path.basename(dst),
+        'ok': not error,
+        'error': str(error) if error else None,
+        'seconds': seconds,
+        'mbps': size / float(MB) / seconds if seconds > 0 else 0.0
+    }
+
+
+def _gfal_copy_file(src, dst, checksum=None, overwrite=False):
+    """
+    Copy a single file with a gfal2 context borrowed from the pool
+
+    Returns:
+        dict with the per-file result
+    """
+    size = os.path.getsize(src.split("file://", 1)[1])
+    start = time.time()
+    try:
+        error = _gfal_op("filecopy", _gfal_transfer_params(overwrite, checksum),
+                         src, dst)
+    except Exception as e:
+        error = e
+    return _gfal_upload_result(src, dst, error, time.time() - start, size)
+
+
+def _gfal_copy_bulk(sources, destinations):
+    """
+    Copy files with a single bulk gfal2 filecopy call
 
+    User defined checksums cannot be set per file in the bulk form, so the
+    checksums of source and destination are only compared with each other.
 
-def _gfal_upload_files(local_file_paths, directory, filenames):
+    Returns:
+        list with the per-file results; throughput is that of the whole batch
+    """
+    sizes = [os.path.getsize(src.split("file://", 1)[1]) for src in sources]
+    start = time.time()
+    try:
+        errors = _gfal_op("filecopy", _gfal_transfer_params(), sources,
+                          destinations)
+    except Exception as e:
+        errors = [e] * len(sources)
+    seconds = time.time() - start
+    results = []
+    for i in xrange(len(sources)):
+        error = errors[i] if errors else None
+        result = _gfal_upload_result(sources[i], destinations[i], error,
+                                     seconds, sum(sizes))
+        results.append(result)
+    return results
+
+
+def _gfal_upload_files(local_file_paths,
+                       directory,
+                       filenames,
+                       checksums=None,
+                       workers=GFAL2_UPLOAD_WORKERS,
+                       bulk=GFAL2_UPLOAD_BULK,
+                       retries=GFAL2_UPLOAD_RETRIES):
     """
     Upload files to a directory
 
+    Files are copied by up to workers concurrent gfal2 copies, or by one
+    bulk filecopy call if bulk is set. Failed files are then retried one by
+    one (overwriting partial leftovers) instead of aborting the whole batch.
+
     Args:
         directory(str): Directory path
         local_file_paths(list): List of local files paths that will be uploaded
         filenames(list): List of filenames that will be uploaded
+        checksums(list): Expected ADLER32 checksum of every file (optional)
+        workers(int): Number of concurrent copies
+        bulk(bool): Use the gfal2 bulk copy
+        retries(int): Number of retries of every failed file
 
     Returns:
-        None if successful
-        -1 if error
-
+        List of dicts with the per-file result, in filenames order:
+        source, destination, filename, ok, error, seconds, mbps
     """
-    # set transfer parameters
-    params = ctx.transfer_parameters()
-    params.overwrite = False
-    params.checksum_check = True
-
     sources = []
     destinations = []
     for i in xrange(len(local_file_paths)):
@@ -153,148 +989,607 @@ def _gfal_upload_files(local_file_paths, directory, filenames):
         gfal_file = "file://" + local_file_path
         sources.append(str(gfal_file))
         destinations.append(str(os.path.join(directory, filename)))
+    if not checksums:
+        checksums = [None] * len(sources)
 
     _flush_logging_msg('gfal-copy (x{}) {}'.format(len(sources), directory))
+    if bulk and len(sources) > 1:
+        results = _gfal_copy_bulk(sources, destinations)
+    else:
+        pool = ThreadPool(max(1, min(workers, len(sources))))
+        try:
+            results = pool.map(
+                lambda i: _gfal_copy_file(sources[i], destinations[i],
+                                          checksums[i]), xrange(len(sources)))
+        finally:
+            pool.close()
+
+    for i in xrange(len(results)):
+        attempt = 0
+        while not results[i]['ok'] and attempt < retries:
+            attempt += 1
+            _flush_logging_msg("{} => {} failed: {} (retry {}/{})".format(
+                sources[i], destinations[i], results[i]['error'], attempt,
+                retries))
+            results[i] = _gfal_copy_file(sources[i],
+                                         destinations[i],
+                                         checksums[i],
+                                         overwrite=True)
+        if not results[i]['ok']:
+            _flush_logging_msg("{} => {} failed: {}".format(
+                sources[i], destinations[i], results[i]['error']))
+
+    succeeded = [result for result in results if result['ok']]
+    _flush_logging_msg('gfal-copy (ok:{} failed:{}) {:.1f}MB/s {}'.format(
+        len(succeeded),
+        len(results) - len(succeeded),
+        sum(result['mbps'] for result in succeeded) / max(1, len(succeeded)),
+        directory))
+    return results
+
+
+def _gfal_mkdir(url):
+    """
+    Create a directory, which may have been created concurrently already
+    """
     try:
-        for i in xrange(len(sources)):
-            src = sources[i]
-            dst = destinations[i]
-            error = ctx.filecopy(params, src, dst)
-            if not error:
-                pass
-                # _flush_logging_msg("{} => {} succeeded!".format(src, dst))
-            else:
-                _flush_logging_msg("{} => {} failed [{}] {}".format(
-                    src, dst, error.code, error.message))
-                return -1
-    except Exception as e:
-        _flush_logging_msg("Copy failed: {}".format(e))
-        return -1
-
-    return None
+        _gfal_op("mkdir", str(url), 0775)
+    except gfal2.GError as e:
+        if e.code != errno.EEXIST:
+            raise
 
 
-def _gfal_setup_folders(endpnt_list, testing_folder, cleanup=False):
+def _gfal_setup_endpoint(endpnt, testing_folder, cleanup=False):
     """
-    Setup folders at endpoint
+    Setup folders at a single endpoint
 
     Args:
-        endpnt_list(str): List of endpoints to setup folders at
+        endpnt(str): Endpoint to setup folders at
         testing_folder(str): Folder name to remove/create
-    Returns: None
+        cleanup(bool): Clean up the destination folder afterwards
+
+    Returns:
+        True if successful
+        False if the endpoint is problematic
     """
-    problematic_endpoints = []
+    # list directories/files
+    _flush_logging_msg('gfal-ls {}'.format(endpnt))
+    try:
+        dir_names = _gfal_op("listdir", endpnt)
+    except Exception as e:
+        _flush_logging_msg("gfal-ls failed:{}, endpoint:{}".format(e, endpnt))
+        return False
 
-    # for each endpoint
-    for endpnt in endpnt_list:
-        endpnt_noprotocol = endpnt.split("://")[1]
-        # list directories/files
-        _flush_logging_msg('gfal-ls {}'.format(endpnt))
+    base_dir = os.path.join(endpnt, testing_folder)
+    src_dir = os.path.join(endpnt, testing_folder, "src")
+    dest_dir = os.path.join(endpnt, testing_folder, "dest")
+
+    # if folder does not exist
+    if testing_folder not in dir_names:
+        # create folder
+        _flush_logging_msg('gfal-mkdir {}'.format(base_dir))
         try:
-            dir_names = ctx.listdir(endpnt)
+            _gfal_mkdir(base_dir)
+            _gfal_mkdir(src_dir)
+            _gfal_mkdir(dest_dir)
         except Exception as e:
-            _flush_logging_msg("gfal-ls failed:{}, endpoint:{}".format(
-                e, endpnt))
-            problematic_endpoints.append(endpnt_noprotocol)
-            continue
-
-        base_dir = os.path.join(endpnt, testing_folder)
-        src_dir = os.path.join(endpnt, testing_folder, "src")
-        dest_dir = os.path.join(endpnt, testing_folder, "dest")
-
-        # if folder does not exist
-        if testing_folder not in dir_names:
-            # create folder
-            _flush_logging_msg('gfal-mkdir {}'.format(base_dir))
+            _flush_logging_msg("gfal-mkdir failed:{}, dir:{}".format(
+                e, base_dir))
+            return False
+    else:
+        try:
+            dir_names = _gfal_op("listdir", str(base_dir))
+        except Exception as e:
+            _flush_logging_msg("gfal-ls failed:{}, dir:{}".format(e, base_dir))
+            return False
+        if "src" not in dir_names:
+            _flush_logging_msg('gfal-mkdir {}'.format(src_dir))
             try:
-                ctx.mkdir(str(base_dir), 0775)
-                ctx.mkdir(str(src_dir), 0775)
-                ctx.mkdir(str(dest_dir), 0775)
+                _gfal_mkdir(src_dir)
             except Exception as e:
                 _flush_logging_msg("gfal-mkdir failed:{}, dir:{}".format(
                     e, base_dir))
-                problematic_endpoints.append(endpnt_noprotocol)
-                continue
-        else:
+                return False
+        if "dest" not in dir_names:
+            _flush_logging_msg('gfal-mkdir {}'.format(dest_dir))
             try:
-                dir_names = ctx.listdir(str(base_dir))
+                _gfal_mkdir(dest_dir)
             except Exception as e:
-                _flush_logging_msg("gfal-ls failed:{}, dir:{}".format(
-                    e, base_dir))
-                problematic_endpoints.append(endpnt_noprotocol)
-                continue
-            if "src" not in dir_names:
-                _flush_logging_msg('gfal-mkdir {}'.format(src_dir))
-                try:
-                    ctx.mkdir(str(src_dir), 0775)
-                except Exception as e:
-                    _flush_logging_msg("gfal-mkdir failed:{}, dir:{}".format(
-                        e, base_dir))
-                    problematic_endpoints.append(endpnt_noprotocol)
-                    continue
-            if "dest" not in dir_names:
-                _flush_logging_msg('gfal-mkdir {}'.format(dest_dir))
-                try:
-                    ctx.mkdir(str(dest_dir), 0775)
-                except Exception as e:
-                    _flush_logging_msg("gfal-mkdir failed:{}, dir:{}".format(
-                        e, dest_dir))
-                    problematic_endpoints.append(endpnt_noprotocol)
-                    continue
-        if cleanup:
-            _flush_logging_msg("Cleaning up destination folder")
-            _gfal_clean_up_dir(dest_dir, hours=2)
+                _flush_logging_msg("gfal-mkdir failed:{}, dir:{}".format(
+                    e, dest_dir))
+                return False
+    if cleanup:
+        _flush_logging_msg("Cleaning up destination folder")
+        _gfal_clean_up_dir(dest_dir, hours=2)
 
-    return problematic_endpoints
+    return True
 
 
-def _gfal_check_files(directory, filesize, numfile):
+class _HealthCache(object):
     """
+    Endpoint health kept on disk between runs, with a circuit breaker
+
+    Every endpoint has a failure score in [0, 1]: each outcome moves the
+    score halfway towards 1 (failure) or 0 (success), and between runs the
+    score decays towards 0 with a half-life of HEALTH_HALF_LIFE seconds.
+    The circuit of an endpoint is open (the endpoint is known bad) when its
+    score exceeds HEALTH_OPEN_SCORE; such endpoints are only probed with a
+    short timeout before being given the full GFAL2_TIMEOUT.
     """
-    return_filenames = []
 
-    _flush_logging_msg('gfal-ls {}'.format(directory))
+    def __init__(self, path=HEALTH_CACHE):
+        self.path = path
+        self.lock = threading.Lock()
+        # endpoint -> {'score', 'latency', 'failures', 'updated'}
+        self.endpoints = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as json_file:
+                    self.endpoints = json.load(json_file)
+            except (IOError, ValueError) as e:
+                _flush_logging_msg("Ignoring health cache {}: {}".format(
+                    path, e))
+
+    def _score(self, endpnt, now):
+        health = self.endpoints.get(endpnt)
+        if health is None:
+            return 0.0
+        elapsed = max(0.0, now - health['updated'])
+        return health['score'] * 0.5**(elapsed / HEALTH_HALF_LIFE)
+
+    def is_open(self, endpnt):
+        """
+        True if the endpoint is currently considered bad
+        """
+        with self.lock:
+            return self._score(endpnt, time.time()) > HEALTH_OPEN_SCORE
+
+    def record(self, endpnt, ok, latency=None):
+        """
+        Record the outcome (and latency in seconds) of using an endpoint
+        """
+        now = time.time()
+        with self.lock:
+            score = self._score(endpnt, now)
+            health = self.endpoints.setdefault(endpnt, {
+                'latency': None,
+                'failures': 0
+            })
+            health['score'] = (score + (0.0 if ok else 1.0)) / 2
+            health['updated'] = now
+            health['failures'] = 0 if ok else health['failures'] + 1
+            if ok and latency is not None:
+                if health['latency'] is None:
+                    health['latency'] = latency
+                else:
+                    health['latency'] = (health['latency'] + latency) / 2
+
+    def save(self):
+        """
+        Atomically write the cache to disk
+        """
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = "{}.{}".format(self.path, os.getpid())
+        with self.lock:
+            with open(temp_path, "w") as json_file:
+                json.dump(self.endpoints, json_file, indent=2, sort_keys=True)
+        os.rename(temp_path, self.path)
+
+
+def _gfal_probe_endpoint(endpnt, contexts=_gfal_probe_contexts):
+    """
+    List an endpoint with a short timeout
+
+    Returns:
+        True if the endpoint answered
+    """
     try:
-        filenames = ctx.listdir(str(directory))
+        _gfal_op("listdir", endpnt, contexts=contexts)
+        return True
     except Exception as e:
-        _flush_logging_msg("gfal-ls failed:{}, endpoint:{}".format(
-            e, directory))
-        return -1
+        _flush_logging_msg("probe failed:{}, endpoint:{}".format(e, endpnt))
+        return False
 
-    if filenames:
-        # we have files
-        if len(filenames) < numfile:
-            # we have less files than we want
-            return []
-        for file in filenames:
-            if file.endswith("{}mb".format(filesize)):
-                return_filenames.append(file)
-            if len(return_filenames) == numfile:
-                # prevents source having more files than needed error
-                break
-        if len(return_filenames) < numfile:
-            # we have less files of filesize than we want
-            # returns empty list although not optinal
-            # best solution would be to return as many files as we have
-            # and then just upload remaining number of files
-            return []
-    else:
-        # no files at all
-        return []
 
-    return return_filenames
+def _gfal_probe_endpoints(endpnt_list, workers=GFAL2_SETUP_WORKERS):
+    """
+    Probe endpoints in parallel
 
+    Returns:
+        List of the endpoints that answered
+    """
+    if not endpnt_list:
+        return []
+    pool = ThreadPool(max(1, min(workers, len(endpnt_list))))
+    try:
+        results = pool.map(_gfal_probe_endpoint, endpnt_list)
+    finally:
+        pool.close()
+    return [endpnt for endpnt, ok in zip(endpnt_list, results) if ok]
+
+
+def _gfal_setup_folders(endpnt_list,
+                        testing_folder,
+                        cleanup=False,
+                        workers=GFAL2_SETUP_WORKERS,
+                        deadline=GFAL2_SETUP_DEADLINE,
+                        health=None,
+                        deadlines=None):
+    """
+    Setup folders at endpoints
 
-# ------------------------------------------------------------------------------
+    Endpoints are set up concurrently by a pool of workers, borrowing gfal2
+    contexts from the shared pool. An endpoint that has not finished within
+    deadline seconds of its worker picking it up is reported as problematic;
+    its worker is abandoned (daemon thread) instead of stalling the rest of
+    the setup, and whatever it finds later is not recorded.
 
+    With a health cache, endpoints whose circuit is open are first probed
+    with a short timeout; those not answering are skipped as problematic
+    without spending the full timeout on them. Outcomes are recorded in the
+    cache.
 
-def _fts_poll_job(context, job_id):
-    """
+    Args:
+        endpnt_list(str): List of endpoints to setup folders at
+        testing_folder(str): Folder name to remove/create
+        cleanup(bool): Clean up the destination folders
+        workers(int): Number of endpoints set up concurrently
+        deadline(int): Per-endpoint deadline in seconds
+        health(_HealthCache): Endpoint health cache (optional)
+        deadlines(dict): Per-endpoint deadlines overriding deadline
+    Returns:
+        List of problematic endpoints (without protocol), in endpnt_list order
     """
-    try:
-        while True:
-            response = json.loads(context.get("/jobs/" + job_id))
-            if response['http_status'] == "200 Ok":
+    started = {}
+    setup_ok = {}
+    # endpoints given up on, their late outcome is not recorded
+    abandoned = set()
+    abandoned_lock = threading.Lock()
+
+    candidates = endpnt_list
+    if health is not None:
+        known_bad = [endpnt for endpnt in endpnt_list if health.is_open(endpnt)]
+        if known_bad:
+            _flush_logging_msg("Probing {} known bad endpoints".format(
+                len(known_bad)))
+            alive = _gfal_probe_endpoints(known_bad, workers)
+            for endpnt in known_bad:
+                if endpnt not in alive:
+                    _flush_logging_msg(
+                        "Skipping known bad endpoint: {}".format(endpnt))
+                    setup_ok[endpnt] = False
+                    health.record(endpnt, False)
+            candidates = [
+                endpnt for endpnt in endpnt_list if endpnt not in setup_ok
+            ]
+
+    def _setup(endpnt):
+        started[endpnt] = time.time()
+        ok = _gfal_setup_endpoint(endpnt, testing_folder, cleanup)
+        with abandoned_lock:
+            if health is not None and endpnt not in abandoned:
+                health.record(endpnt, ok, time.time() - started[endpnt])
+        return ok
+
+    workers = max(1, min(workers, len(candidates)))
+    pool = ThreadPool(workers)
+    pending = dict(
+        (endpnt, pool.apply_async(_setup, (endpnt,))) for endpnt in candidates)
+    pool.close()
+    # endpoints still queued behind hung workers are given up eventually
+    deadlines = deadlines or {}
+    rounds = (len(candidates) + workers - 1) // workers
+    give_up_at = time.time() + rounds * max([deadline] +
+                                            list(deadlines.values()))
+
+    while pending:
+        for endpnt, result in list(pending.items()):
+            if result.ready():
+                try:
+                    setup_ok[endpnt] = result.get()
+                except Exception as e:
+                    _flush_logging_msg("setup failed:{}, endpoint:{}".format(
+                        e, endpnt))
+                    setup_ok[endpnt] = False
+            elif (endpnt in started and time.time() - started[endpnt] >
+                  deadlines.get(endpnt, deadline)) or \
+                    time.time() > give_up_at:
+                _flush_logging_msg(
+                    "setup exceeded deadline of {}s, endpoint:{}".format(
+                        deadlines.get(endpnt, deadline), endpnt))
+                setup_ok[endpnt] = False
+                with abandoned_lock:
+                    abandoned.add(endpnt)
+                    if health is not None:
+                        health.record(endpnt, False)
+            else:
+                continue
+            del pending[endpnt]
+        if pending:
+            time.sleep(0.1)
+
+    problematic_endpoints = []
+    for endpnt in endpnt_list:
+        if not setup_ok[endpnt]:
+            problematic_endpoints.append(endpnt.split("://")[1])
+    return problematic_endpoints
+
+
+class _ListingCache(object):
+    """
+    Per-run cache of directory listings, indexed by file size
+
+    Test files carry their size in the "_<size>mb" suffix of their name, so
+    "does the directory hold N files of X MB" becomes a dictionary lookup
+    once the directory has been listed. Uploads add to the cached listing
+    instead of invalidating it.
+    """
+
+    SIZE_SUFFIX = re.compile(r'_([0-9]+)mb$')
+
+    def __init__(self, ttl=GFAL2_LISTING_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # directory -> (listed_at, {filesize: [filenames]})
+        self.entries = {}
+
+    def get(self, directory):
+        """
+        Return {filesize: [filenames]} for directory, None if not cached
+        """
+        with self.lock:
+            entry = self.entries.get(directory)
+            if entry is None:
+                return None
+            if self.ttl and time.time() - entry[0] > self.ttl:
+                del self.entries[directory]
+                return None
+            return entry[1]
+
+    def put(self, directory, filenames):
+        """
+        Cache the listing of a directory
+        """
+        index = {}
+        for filename in filenames:
+            match = self.SIZE_SUFFIX.search(filename)
+            if match:
+                index.setdefault(int(match.group(1)), []).append(filename)
+        with self.lock:
+            self.entries[directory] = (time.time(), index)
+
+    def add(self, directory, filenames):
+        """
+        Record files written to a directory (no-op if it is not cached)
+        """
+        with self.lock:
+            entry = self.entries.get(directory)
+            if entry is None:
+                return
+            for filename in filenames:
+                match = self.SIZE_SUFFIX.search(filename)
+                if match:
+                    entry[1].setdefault(int(match.group(1)),
+                                        []).append(filename)
+
+    def remove(self, directory, filenames):
+        """
+        Record files removed from a directory (no-op if it is not cached)
+        """
+        filenames = set(filenames)
+        with self.lock:
+            entry = self.entries.get(directory)
+            if entry is None:
+                return
+            for filesize, cached in entry[1].items():
+                entry[1][filesize] = [
+                    filename for filename in cached if filename not in filenames
+                ]
+
+
+_listing_cache = _ListingCache()
+
+
+def _gfal_check_files(directory, filesize, numfile, cache=_listing_cache):
+    """
+    Find existing files of a given size in a directory
+
+    The directory is listed once per run (or per cache TTL); later checks
+    are answered from the cached listing.
+
+    Args:
+        directory(str): Directory path
+        filesize(int): File size in MB
+        numfile(int): Number of files wanted, None for all
+        cache(_ListingCache): Listing cache
+
+    Returns:
+        List of at most numfile filenames of filesize MB, possibly fewer
+        -1 if error
+    """
+    index = cache.get(directory)
+    if index is None:
+        _flush_logging_msg('gfal-ls {}'.format(directory))
+        try:
+            filenames = _gfal_op("listdir", str(directory))
+        except Exception as e:
+            _flush_logging_msg("gfal-ls failed:{}, endpoint:{}".format(
+                e, directory))
+            return -1
+        cache.put(directory, filenames)
+        index = cache.get(directory)
+
+    # never more than numfile, prevents source having more files than needed
+    return list(index.get(filesize, [])[:numfile])
+
+
+# local manifests of the source files, one per source directory
+SOURCE_POOL_DIR = os.getenv(
+    "FTS_SOURCE_POOL",
+    os.path.join(os.path.expanduser("~"), ".fts-datalake", "source-pool"))
+
+
+class _SourcePool(object):
+    """
+    Pool of source files kept at every (source directory, filesize)
+
+    A local manifest per source directory records the files uploaded there
+    with their size, adler32 and upload time. The directory listing stays
+    the authority on what exists: tracked files that disappeared are
+    forgotten, files that are there but untracked (e.g. uploaded by older
+    versions) are used after the tracked ones, without a known checksum.
+    """
+
+    def __init__(self, directory=SOURCE_POOL_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        # source directory -> {filename: {'size', 'adler32', 'created'}}
+        self.manifests = {}
+
+    def _path(self, source_dir):
+        return os.path.join(self.directory,
+                            hashlib.sha1(source_dir).hexdigest() + ".json")
+
+    def _load(self, path):
+        if not os.path.isfile(path):
+            return {}
+        try:
+            with open(path) as json_file:
+                return json.load(json_file)['files']
+        except (IOError, ValueError, KeyError) as e:
+            _flush_logging_msg("Ignoring manifest {}: {}".format(path, e))
+            return {}
+
+    def _manifest(self, source_dir):
+        manifest = self.manifests.get(source_dir)
+        if manifest is None:
+            manifest = self._load(self._path(source_dir))
+            self.manifests[source_dir] = manifest
+        return manifest
+
+    def _update(self, source_dir, added=None, removed=()):
+        """
+        Apply changes to the manifest of a source directory and save it
+
+        The manifest is re-read under an exclusive lock of its file before
+        the changes are applied, so processes sharing the pool directory
+        (shards, the launcher) do not lose each other's changes.
+        """
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        path = self._path(source_dir)
+        with open(path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            manifest = self._load(path)
+            manifest.update(added or {})
+            for filename in removed:
+                manifest.pop(filename, None)
+            temp_path = "{}.{}".format(path, os.getpid())
+            with open(temp_path, "w") as json_file:
+                json.dump({
+                    'directory': source_dir,
+                    'files': manifest
+                }, json_file)
+            os.rename(temp_path, path)
+        self.manifests[source_dir] = manifest
+        return manifest
+
+    def select(self, source_dir, filesize, numfile):
+        """
+        Pick the existing files of a pool, tracked ones first
+
+        Args:
+            source_dir(str): Source directory
+            filesize(int): File size in MB
+            numfile(int): Number of files wanted, None for all
+
+        Returns:
+            Tuple (filenames, {filename: adler32} of the tracked ones)
+            -1 if the directory cannot be listed
+        """
+        present = _gfal_check_files(source_dir, filesize, None)
+        if present == -1:
+            return -1
+        with self.lock:
+            manifest = self._manifest(source_dir)
+            gone = [
+                filename for filename, entry in manifest.items()
+                if entry['size'] == filesize and filename not in present
+            ]
+            if gone:
+                manifest = self._update(source_dir, removed=gone)
+            tracked = sorted(
+                (filename for filename in present if filename in manifest),
+                key=lambda filename: manifest[filename]['created'])
+            untracked = [
+                filename for filename in present if filename not in manifest
+            ]
+            filenames = (tracked + untracked)[:numfile]
+            checksums = dict((filename, manifest[filename]['adler32'])
+                             for filename in filenames
+                             if filename in manifest)
+        return filenames, checksums
+
+    def add(self, source_dir, filesize, checksums):
+        """
+        Track files uploaded to a source directory
+
+        Args:
+            checksums(dict): {filename: adler32} of the uploaded files
+        """
+        now = time.time()
+        with self.lock:
+            self._update(source_dir,
+                         added=dict((filename, {
+                             'size': filesize,
+                             'adler32': adler32,
+                             'created': now
+                         }) for filename, adler32 in checksums.items()))
+
+    def remove(self, source_dir, filenames):
+        """
+        Forget files removed from a source directory
+        """
+        with self.lock:
+            self._update(source_dir, removed=filenames)
+
+
+# ------------------------------------------------------------------------------
+
+# minimum seconds between two polls of a job
+FTS_POLL_SLEEP = int(os.getenv("FTS_POLL_SLEEP", 2))
+# job ids queried per status request
+FTS_POLL_BATCH = int(os.getenv("FTS_POLL_BATCH", 50))
+# maximum seconds between two polls of a job
+FTS_POLL_MAX_SLEEP = int(os.getenv("FTS_POLL_MAX_SLEEP", 120))
+# relative random spread of the poll times, keeps jobs from polling in step
+FTS_POLL_JITTER = float(os.getenv("FTS_POLL_JITTER", 0.1))
+# jobs due within this many seconds are polled along with the due ones
+FTS_POLL_COALESCE = float(os.getenv("FTS_POLL_COALESCE", 1))
+# hours of results the per-link throughput estimates are based on
+FTS_POLL_HISTORY = float(os.getenv("FTS_POLL_HISTORY", 7 * 24))
+# throughput (MB/s) assumed for links without history
+FTS_POLL_DEFAULT_MBPS = float(os.getenv("FTS_POLL_DEFAULT_MBPS", 10))
+# seconds FTS needs to schedule and start a job
+FTS_JOB_OVERHEAD = float(os.getenv("FTS_JOB_OVERHEAD", 5))
+# failed status requests after which a job is no longer polled
+FTS_POLL_MAX_ERRORS = int(os.getenv("FTS_POLL_MAX_ERRORS", 3))
+
+
+def _fts_poll_job(context, job_id):
+    """
+    """
+    try:
+        while True:
+            response = json.loads(context.get("/jobs/" + job_id))
+            if response['http_status'] == "200 Ok":
                 if response["job_finished"]:
                     _flush_logging_msg(
                         'Job with id {} finished with job_state:{}'.format(
@@ -311,70 +1606,255 @@ def _fts_poll_job(context, job_id):
     return response['job_state']
 
 
-def _fts_wait_jobs(context, job_map_list, sleep_time=10):
+def _fts_get_jobs_status(context, job_ids):
     """
+    Get the status of several jobs with a single request
+
+    Args:
+        context: FTS context
+        job_ids(list): List of job ids
+
+    Returns:
+        dict mapping job id to its status (without the file list)
     """
-    finished_jobs = []
-    while len(finished_jobs) < len(job_map_list):
-        for job_map in job_map_list:
+    with _phase("poll"), _fts_timed("poll"):
+        response = json.loads(context.get("/jobs/" + ",".join(job_ids)))
+    # a single job id is answered with the job itself, several with a list
+    if isinstance(response, dict):
+        response = [response]
+    return dict((status['job_id'], status) for status in response)
+
+
+def _fts_get_job_files(context, job_id):
+    """
+    Get the file list of a job
+    """
+    with _phase("poll"), _fts_timed("files"):
+        return json.loads(context.get("/jobs/{}/files".format(job_id)))
+
+
+def _fts_purge_job(job_map, deleter, done=None):
+    """
+    Queue the removal of the destination files of a finished job
+
+    All files the job could have written are queued, whatever the job and
+    file states; the deleter only removes the ones it finds at the
+    destination. done is called once they are purged.
+    """
+    _flush_logging_msg("Removing testing files from destination")
+    deleter.submit(job_map['purge'], done)
+
+
+def _fts_job_estimate(job_map, throughput):
+    """
+    Expected seconds from the submission of a job to its completion
+
+    The links of a job are transferred in parallel and the files of a link
+    one after the other, at the historical median throughput of the link
+    (FTS_POLL_DEFAULT_MBPS without history).
+
+    Args:
+        job_map(dict): Job map with the links of the job
+        throughput(dict): {(source_se, dest_se): MB/s}
+    """
+    seconds = 0.0
+    for link in job_map.get('links', []):
+        mbps = throughput.get((_gfal_endpoint(link['source']),
+                               _gfal_endpoint(link['destination'])))
+        seconds = max(
+            seconds, link['filesize'] * link['numfile'] /
+            float(mbps or FTS_POLL_DEFAULT_MBPS))
+    return FTS_JOB_OVERHEAD + seconds
+
+
+def _fts_poll_delay(remaining, sleep_time, max_sleep):
+    """
+    Seconds until the next poll of a job
+
+    A job is polled when it is expected to finish; once overdue, after half
+    of its delay so far, so that late jobs are polled less and less often.
+    The delay is kept within [sleep_time, max_sleep] and spread by
+    FTS_POLL_JITTER.
+    """
+    delay = remaining if remaining > 0 else -remaining / 2.0
+    delay = min(max_sleep, max(sleep_time, delay))
+    return delay * random.uniform(1 - FTS_POLL_JITTER, 1 + FTS_POLL_JITTER)
+
+
+def _fts_wait_jobs(context,
+                   job_map_list,
+                   sleep_time=FTS_POLL_SLEEP,
+                   deleter=None,
+                   max_sleep=FTS_POLL_MAX_SLEEP,
+                   incoming=None,
+                   on_finished=None,
+                   results=None,
+                   checkpoint=None):
+    """
+    Poll jobs when due (see _fts_poll_delay) and purge their files
+
+    Args:
+        context: FTS client
+        job_map_list(list): Job maps of the submitted jobs
+        sleep_time(float): Shortest interval between two polls of a job
+        deleter(_Deleter): Purge planner, one is created for the call if None
+        max_sleep(float): Longest interval between two polls of a job
+        incoming(Queue): Job maps submitted while polling, until None
+        on_finished(callable): Called with every job map no longer polled
+        results(_ResultsStore): Store of the files of the finished jobs
+        checkpoint(_Checkpoint): Jobs left until their files are purged
+    """
+    own_deleter = deleter is None
+    if own_deleter:
+        deleter = _Deleter()
+    throughput = {}
+    if results is not None:
+        throughput = results.link_throughput(time.time() -
+                                             FTS_POLL_HISTORY * 3600)
+    job_maps = {}
+    active = set()
+    errors = {}
+    expected = {}
+    # (next poll time, job id)
+    schedule = []
+    closed = incoming is None
+
+    def _add(job_map):
+        job_id = job_map['job_id']
+        job_maps[job_id] = job_map
+        active.add(job_id)
+        errors[job_id] = 0
+        expected[job_id] = job_map.get('submitted', time.time()) + \
+            _fts_job_estimate(job_map, throughput)
+        _reschedule(job_id)
+
+    def _reschedule(job_id, delay=None):
+        if delay is None:
+            delay = _fts_poll_delay(expected[job_id] - time.time(), sleep_time,
+                                    max_sleep)
+        heapq.heappush(schedule, (time.time() + delay, job_id))
+
+    def _done(job_id):
+        active.discard(job_id)
+        if on_finished:
+            on_finished(job_maps[job_id])
+
+    for job_map in job_map_list:
+        _add(job_map)
+
+    while active or not closed:
+        # wait for the next due job, taking in the jobs submitted meanwhile
+        wait = max(0, schedule[0][0] - time.time()) if schedule else None
+        if not closed:
             try:
-                job_id = job_map['job_id']
-                if job_id in finished_jobs:
-                    continue
-                response = fts3.get_job_status(context, job_id, list_files=True)
-                if response['http_status'] == "200 Ok":
-                    if response["job_finished"]:
-                        finished_jobs.append(job_id)
-                        _flush_logging_msg(
-                            'Job with id {} finished with job_state:{} | {}/{}'.
-                            format(job_id, response['job_state'],
-                                   len(finished_jobs), len(job_map_list)))
-
-                        if response['job_state'] == "FINISHED":
-                            _gfal_rm_files(job_map['files_to_purge'],
-                                           job_map['directory'])
-                            _flush_logging_msg(
-                                "Removing testing files from destination")
-                        else:
-                            filenames = []
-                            for file_map in response['files']:
-                                if file_map['file_state'] == 'FINISHED':
-                                    filenames.append(
-                                        file_map['dest_surl'].split(
-                                            "/dest/")[1])
-                            _flush_logging_msg(
-                                "Removing testing files from destination")
-                            _gfal_rm_files(filenames, job_map['directory'])
+                job_map = incoming.get(timeout=wait)
+            except Queue.Empty:
+                job_map = False
+            if job_map is not False:
+                if job_map is None:
+                    closed = True
                 else:
-                    _flush_logging_msg('Server http status: {}'.format(
-                        response['http_status']))
-                    finished_jobs.append(job_id)
+                    _add(job_map)
+                continue
+        elif wait:
+            time.sleep(wait)
+
+        due = []
+        horizon = time.time() + FTS_POLL_COALESCE
+        while schedule and schedule[0][0] <= horizon:
+            job_id = heapq.heappop(schedule)[1]
+            if job_id in active and job_id not in due:
+                due.append(job_id)
+        if not due:
+            continue
+
+        for k in xrange(0, len(due), FTS_POLL_BATCH):
+            batch = due[k:k + FTS_POLL_BATCH]
+            try:
+                statuses = _fts_get_jobs_status(context, batch)
             except Exception as e:
-                _flush_logging_msg("Polling failed:{}, response:{}".format(
-                    e, response))
-                finished_jobs.append(job_id)
-        _flush_logging_msg(
-            "Sleeping for {} seconds before commencing polling again..".format(
-                sleep_time))
-        time.sleep(sleep_time)
+                _flush_logging_msg("Polling failed:{}, jobs:{}".format(
+                    e, len(batch)))
+                for job_id in batch:
+                    errors[job_id] += 1
+                    if errors[job_id] >= FTS_POLL_MAX_ERRORS:
+                        _done(job_id)
+                    else:
+                        _reschedule(job_id, sleep_time)
+                continue
+            for job_id in batch:
+                status = statuses.get(job_id, {'http_status': "404 Not Found"})
+                if status.get('http_status', "200 Ok") != "200 Ok":
+                    _flush_logging_msg('Server http status: {}'.format(
+                        status['http_status']))
+                    _done(job_id)
+                    if checkpoint is not None:
+                        checkpoint.remove(job_maps[job_id])
+                    continue
+                if not status["job_finished"]:
+                    _reschedule(job_id)
+                    continue
+                active.discard(job_id)
+                _metrics.inc("fts_datalake_fts_jobs_total",
+                             {'state': status['job_state']})
+                _flush_logging_msg(
+                    'Job with id {} finished with job_state:{} | {}/{}'.format(
+                        job_id, status['job_state'],
+                        len(job_maps) - len(active), len(job_maps)))
+                try:
+                    # the job stays checkpointed until its files are gone
+                    _fts_purge_job(
+                        job_maps[job_id], deleter,
+                        None if checkpoint is None else functools.partial(
+                            checkpoint.remove, job_maps[job_id]))
+                except Exception as e:
+                    _flush_logging_msg("Purging failed:{}, job:{}".format(
+                        e, job_id))
+                if results is not None:
+                    try:
+                        files = _fts_get_job_files(context, job_id)
+                        results.record(status, files,
+                                       job_maps[job_id].get('run_id'))
+                    except Exception as e:
+                        _flush_logging_msg(
+                            "Recording results failed:{}, job:{}".format(
+                                e, job_id))
+                if on_finished:
+                    on_finished(job_maps[job_id])
+    if own_deleter:
+        deleter.close()
     return None
 
 
-def _fts_submit_job(source_url, dest_url, src_filenames, dst_filenames,
-                    checksum, overwrite, testing_folder, context, metadata):
+def _fts_transfer(source_file, dest_file, checksum=None, metadata=None):
     """
-    https://gitlab.cern.ch/fts/fts-rest/-/blob/develop/src/fts3/rest/client/easy/submission.py#L106
+    Describe a single transfer of a job
+
+    Args:
+        source_file(str): Source file URL
+        dest_file(str): Destination file URL
+        checksum(str): Known ADLER32 checksum of the source file (optional)
+        metadata(dict): File metadata (optional)
     """
+    known_checksum = None
+    if checksum:
+        known_checksum = "ADLER32:{}".format(checksum)
+    return fts3.new_transfer(source=source_file,
+                             destination=dest_file,
+                             checksum=known_checksum,
+                             metadata=metadata)
 
-    transfers = []
-    for i in xrange(len(src_filenames)):
-        source_file = os.path.join(source_url, testing_folder, "src",
-                                   src_filenames[i])
-        dest_file = os.path.join(dest_url, testing_folder, "dest",
-                                 dst_filenames[i])
-        transfer = fts3.new_transfer(source=source_file, destination=dest_file)
-        transfers.append(transfer)
 
+def _fts_submit_transfers(transfers, checksum, overwrite, context, metadata):
+    """
+    Submit a job made of the given transfers
+
+    https://gitlab.cern.ch/fts/fts-rest/-/blob/develop/src/fts3/rest/client/easy/submission.py#L106
+
+    Returns:
+        job id if successful
+        -1 if error
+    """
     # create job
     job = fts3.new_job(transfers,
                        verify_checksum=checksum,
@@ -383,15 +1863,1850 @@ def _fts_submit_job(source_url, dest_url, src_filenames, dst_filenames,
                        metadata=metadata)
 
     # submit job
-    while True:
+    try:
+        _fts_delegate()
+        with _phase("submit"), _fts_timed("submit"):
+            job_id = json.loads(context.post_json("/jobs", job))['job_id']
+    except (fts3_client_exceptions.ClientError,
+            fts3_client_exceptions.ServerError) as e:
+        _flush_logging_msg(e)
+        return -1
+
+    return job_id
+
+
+def _fts_submit_job(source_url,
+                    dest_url,
+                    src_filenames,
+                    dst_filenames,
+                    checksum,
+                    overwrite,
+                    testing_folder,
+                    context,
+                    metadata,
+                    checksums=None,
+                    src_folder="src",
+                    dest_folder="dest"):
+    """
+    https://gitlab.cern.ch/fts/fts-rest/-/blob/develop/src/fts3/rest/client/easy/submission.py#L106
+
+    checksums(dict) optionally maps a source filename to its known ADLER32
+    checksum, which FTS then verifies instead of asking the source for it.
+    src_folder and dest_folder are the subfolders of the testing folder the
+    files are read from and written to.
+    """
+
+    transfers = []
+    for i in xrange(len(src_filenames)):
+        source_file = os.path.join(source_url, testing_folder, src_folder,
+                                   src_filenames[i])
+        dest_file = os.path.join(dest_url, testing_folder, dest_folder,
+                                 dst_filenames[i])
+        transfers.append(
+            _fts_transfer(source_file, dest_file, (checksums or
+                                                   {}).get(src_filenames[i])))
+
+    return _fts_submit_transfers(transfers, checksum, overwrite, context,
+                                 metadata)
+
+
+# connections kept open to the FTS server
+FTS_POOL_SIZE = int(os.getenv("FTS_POOL_SIZE", 8))
+# seconds before a request to the FTS server is given up
+FTS_REQUEST_TIMEOUT = int(os.getenv("FTS_REQUEST_TIMEOUT", 60))
+# seconds between two checks of the proxy delegated to FTS
+FTS_DELEGATION_REFRESH = int(os.getenv("FTS_DELEGATION_REFRESH", 3600))
+
+
+def _x509_proxy():
+    """
+    Path of the user proxy, None if there is none
+    """
+    proxy = os.getenv("X509_USER_PROXY", "/tmp/x509up_u{}".format(os.getuid()))
+    return proxy if os.path.isfile(proxy) else None
+
+
+class _FtsClient(object):
+    """
+    FTS REST client on a keep-alive requests.Session
+
+    Offers the get/post_json calls of fts3.Context. The proxy and the CA
+    directory are loaded once, and all threads share the connection pool
+    of the session (up to pool_size connections), so submissions and polls
+    run concurrently without a TLS handshake per request.
+    """
+
+    def __init__(self, endpoint=FTS_ENDPOINT, pool_size=FTS_POOL_SIZE):
+        self.endpoint = endpoint.rstrip("/")
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            'Accept': "application/json",
+            'Content-Type': "application/json"
+        })
+        self.session.cert = _x509_proxy()
+        capath = os.getenv("X509_CERT_DIR", "/etc/grid-security/certificates")
+        self.session.verify = capath if os.path.isdir(capath) else True
+
+    def _request(self, method, path, body=None):
+        response = self.session.request(
+            method,
+            self.endpoint + path,
+            data=None if body is None else json.dumps(body),
+            timeout=FTS_REQUEST_TIMEOUT)
+        if response.status_code >= 500:
+            raise fts3_client_exceptions.ServerError("{} {}: {} {}".format(
+                method, path, response.status_code, response.text))
+        if response.status_code >= 400:
+            raise fts3_client_exceptions.ClientError("{} {}: {} {}".format(
+                method, path, response.status_code, response.text))
+        return response.text
+
+    def get(self, path):
+        return self._request("GET", path)
+
+    def post_json(self, path, body):
+        return self._request("POST", path, body)
+
+
+_fts_client = None
+_fts_client_lock = threading.Lock()
+
+
+def _fts_context():
+    """
+    Return the FTS client shared by all threads
+    """
+    global _fts_client
+    with _fts_client_lock:
+        if _fts_client is None:
+            _fts_client = _FtsClient()
+        return _fts_client
+
+
+_fts_delegation = {'context': None, 'checked_at': 0}
+_fts_delegation_lock = threading.Lock()
+
+
+def _fts_delegate():
+    """
+    Make sure FTS holds a valid delegated proxy
+
+    Delegation needs the fts3 client, which signs the proxy request FTS
+    hands out; its context loads the proxy and the CA a second time, next
+    to _FtsClient, but only once per process. The delegation is checked
+    again at most every FTS_DELEGATION_REFRESH seconds (fts3 only renews it
+    when it is about to expire).
+    """
+    with _fts_delegation_lock:
+        if time.time() - _fts_delegation['checked_at'] < \
+                FTS_DELEGATION_REFRESH:
+            return
+        if _fts_delegation['context'] is None:
+            # https://gitlab.cern.ch/fts/fts-rest/-/blob/develop/src/fts3/rest/client/context.py#L148
+            _fts_delegation['context'] = fts3.Context(FTS_ENDPOINT, verify=True)
+        fts3.delegate(_fts_delegation['context'], lifetime=timedelta(hours=7))
+        _fts_delegation['checked_at'] = time.time()
+
+
+# ------------------------------------------------------------------------------
+
+# SQLite database collecting the per-file results of every run
+RESULTS_DB = os.getenv(
+    "FTS_RESULTS_DB",
+    os.path.join(os.path.expanduser("~"), ".fts-datalake", "results.sqlite"))
+
+
+def _fts_timestamp(value):
+    """
+    Convert an FTS timestamp (2020-05-04T12:00:00) to seconds since epoch
+    """
+    if not value:
+        return None
+    return calendar.timegm(
+        datetime.strptime(value[:19], "%Y-%m-%dT%H:%M:%S").timetuple())
+
+
+def _percentile(values, percent):
+    """
+    Nearest-rank percentile of a sorted list
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+class _ResultsStore(object):
+    """
+    Local SQLite store of the per-file results of finished FTS jobs
+
+    One row per transferred file, indexed by link (source SE, destination
+    SE) and by finish time, accumulated across runs.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS transfers (
+            run_id TEXT,
+            job_id TEXT,
+            job_state TEXT,
+            protocol TEXT,
+            source_se TEXT,
+            dest_se TEXT,
+            source_surl TEXT,
+            dest_surl TEXT,
+            filesize INTEGER,
+            file_state TEXT,
+            reason TEXT,
+            throughput REAL,
+            start_time REAL,
+            finish_time REAL
+        );
+        CREATE INDEX IF NOT EXISTS transfers_link
+            ON transfers (source_se, dest_se, finish_time);
+        CREATE INDEX IF NOT EXISTS transfers_finish_time
+            ON transfers (finish_time);
+        CREATE INDEX IF NOT EXISTS transfers_job
+            ON transfers (job_id, dest_surl);
+    """
+
+    def __init__(self, path=RESULTS_DB, run_id=None):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.run_id = run_id
+        self.lock = threading.Lock()
+        # shards of a run may share the database
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.executescript(self.SCHEMA)
+
+    def record(self, status, files, run_id=None):
+        """
+        Store the files of a finished job
+
+        Args:
+            status(dict): Job status as returned by FTS
+            files(list): File list of the job as returned by FTS
+            run_id(str): Run that submitted the job, defaults to this run
+        """
+        run_id = run_id or self.run_id
+        rows = []
+        for file_map in files:
+            source_surl = file_map['source_surl']
+            rows.append((run_id, status['job_id'], status['job_state'],
+                         source_surl.split("://",
+                                           1)[0], _gfal_endpoint(source_surl),
+                         _gfal_endpoint(file_map['dest_surl']),
+                         source_surl, file_map['dest_surl'],
+                         file_map.get('filesize'), file_map['file_state'],
+                         file_map.get('reason'), file_map.get('throughput'),
+                         _fts_timestamp(file_map.get('start_time')),
+                         _fts_timestamp(file_map.get('finish_time'))))
+        with self.lock:
+            self.db.executemany(
+                "INSERT INTO transfers VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.commit()
+
+    def merge(self, path):
+        """
+        Import the results of another store, e.g. of a shard run elsewhere
+
+        Files already present (same job and destination) are skipped, so
+        merging the same store twice is harmless.
+
+        Returns:
+            Number of imported files
+        """
+        with self.lock:
+            self.db.execute("ATTACH DATABASE ? AS other", (path,))
+            try:
+                merged = self.db.execute(
+                    "INSERT INTO transfers SELECT * FROM other.transfers AS o "
+                    "WHERE NOT EXISTS (SELECT 1 FROM transfers AS t "
+                    "WHERE t.job_id = o.job_id "
+                    "AND t.dest_surl = o.dest_surl)").rowcount
+                self.db.commit()
+            finally:
+                self.db.execute("DETACH DATABASE other")
+        return merged
+
+    def link_throughput(self, since=None):
+        """
+        Median throughput of every link
+
+        Returns:
+            {(source_se, dest_se): MB/s} of the links with known throughput
+        """
+        return dict(((link['source_se'], link['dest_se']), link['mbps_p50'])
+                    for link in self.link_summary(since)
+                    if link['mbps_p50'])
+
+    def link_samples(self, since=None, run_id=None, link=None):
+        """
+        Throughput samples and failures of every link and filesize
+
+        Args:
+            since(float): Only consider files finished after this epoch time
+            run_id(str): Also consider the files of this run, and only count
+                their failures
+            link(tuple): Only consider this (source_se, dest_se)
+
+        Returns:
+            {(source_se, dest_se, filesize): {'mbps': [MB/s of the finished
+            files], 'failed': failed files of run_id}}
+        """
+        query = ("SELECT source_se, dest_se, filesize, file_state, throughput, "
+                 "run_id FROM transfers")
+        conditions = []
+        args = ()
+        if link is not None:
+            conditions.append("source_se = ? AND dest_se = ?")
+            args += tuple(link)
+        if since is not None:
+            conditions.append("(finish_time >= ? OR run_id = ?)")
+            args += (since, run_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        with self.lock:
+            rows = self.db.execute(query, args).fetchall()
+        samples = {}
+        for source_se, dest_se, filesize, file_state, throughput, row_run_id \
+                in rows:
+            link = samples.setdefault((source_se, dest_se, filesize), {
+                'mbps': [],
+                'failed': 0
+            })
+            if file_state == "FINISHED" and throughput:
+                link['mbps'].append(throughput)
+            elif file_state == "FAILED" and row_run_id == run_id:
+                link['failed'] += 1
+        return samples
+
+    def link_summary(self, since=None):
+        """
+        Per-link success rate and throughput percentiles
+
+        Args:
+            since(float): Only consider files finished after this epoch time
+
+        Returns:
+            List of dicts (protocol, source_se, dest_se, files, success_rate,
+            mbps_p50, mbps_p90, mbps_max), sorted by link
+        """
+        query = ("SELECT protocol, source_se, dest_se, file_state, throughput "
+                 "FROM transfers")
+        args = ()
+        if since is not None:
+            query += " WHERE finish_time >= ?"
+            args = (since,)
+        links = OrderedDict()
+        with self.lock:
+            rows = self.db.execute(
+                query + " ORDER BY protocol, source_se, "
+                "dest_se", args).fetchall()
+        for protocol, source_se, dest_se, file_state, throughput in rows:
+            link = links.setdefault((protocol, source_se, dest_se), {
+                'files': 0,
+                'finished': 0,
+                'mbps': []
+            })
+            link['files'] += 1
+            if file_state == 'FINISHED':
+                link['finished'] += 1
+                if throughput:
+                    link['mbps'].append(throughput)
+
+        summary = []
+        for (protocol, source_se, dest_se), link in links.items():
+            mbps = sorted(link['mbps'])
+            summary.append({
+                'protocol': protocol,
+                'source_se': source_se,
+                'dest_se': dest_se,
+                'files': link['files'],
+                'success_rate': link['finished'] / float(link['files']),
+                'mbps_p50': _percentile(mbps, 50),
+                'mbps_p90': _percentile(mbps, 90),
+                'mbps_max': mbps[-1] if mbps else None
+            })
+        return summary
+
+
+def _print_link_report(results, since=None):
+    """
+    Print the per-link summary of the results store
+    """
+    print("{:<8} {:<40} {:<40} {:>6} {:>7} {:>9} {:>9}".format(
+        "protocol", "source", "destination", "files", "success", "p50 MB/s",
+        "p90 MB/s"))
+    for link in results.link_summary(since):
+        print("{:<8} {:<40} {:<40} {:>6} {:>6.0f}% {:>9} {:>9}".format(
+            link['protocol'], link['source_se'], link['dest_se'], link['files'],
+            100 * link['success_rate'], "-" if link['mbps_p50'] is None else
+            "{:.2f}".format(link['mbps_p50']), "-"
+            if link['mbps_p90'] is None else "{:.2f}".format(link['mbps_p90'])))
+
+
+# ------------------------------------------------------------------------------
+
+# jobs submitted but not purged yet, empty to disable
+CHECKPOINT = os.getenv(
+    "FTS_CHECKPOINT",
+    os.path.join(os.path.expanduser("~"), ".fts-datalake", "checkpoint.json"))
+
+
+class _Checkpoint(object):
+    """
+    Durable list of the submitted FTS jobs whose files are not purged yet
+
+    The job maps (job id, destination files, links) are rewritten atomically
+    after every change, so a run that dies while polling can be picked up
+    with --resume. An empty path disables the checkpoint.
+    """
+
+    def __init__(self, path=CHECKPOINT):
+        self.path = path
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        if not path or not os.path.isfile(path):
+            return
         try:
-            job_id = fts3.submit(context, job)
+            with open(path) as checkpoint_file:
+                for job_map in json.load(checkpoint_file)['jobs']:
+                    self.jobs[job_map['job_id']] = job_map
+        except (IOError, ValueError, KeyError) as e:
+            _flush_logging_msg("Ignoring checkpoint {}: {}".format(path, e))
+
+    def job_maps(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def add(self, job_map):
+        with self.lock:
+            self.jobs[job_map['job_id']] = job_map
+            self._save()
+
+    def remove(self, job_map):
+        with self.lock:
+            if self.jobs.pop(job_map['job_id'], None) is not None:
+                self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp_path = "{}.{}".format(self.path, os.getpid())
+        with open(temp_path, "w") as checkpoint_file:
+            json.dump({'jobs': list(self.jobs.values())}, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.rename(temp_path, self.path)
+
+
+# ------------------------------------------------------------------------------
+
+# workers checking sources and generating the missing files
+PIPELINE_PREPARE_WORKERS = int(os.getenv("PIPELINE_PREPARE_WORKERS", 2))
+# workers uploading files to sources (sources uploaded to at once)
+PIPELINE_UPLOAD_WORKERS = int(os.getenv("PIPELINE_UPLOAD_WORKERS", 4))
+# workers submitting FTS jobs
+PIPELINE_SUBMIT_WORKERS = int(os.getenv("PIPELINE_SUBMIT_WORKERS", 4))
+# items waiting between two stages before the upstream stage blocks
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 16))
+# concurrent storage operations (check/upload) per endpoint, 0 for no limit
+PIPELINE_ENDPOINT_OPS = int(os.getenv("PIPELINE_ENDPOINT_OPS", 2))
+# unfinished FTS jobs per endpoint (as source or destination), 0 for no limit
+PIPELINE_ENDPOINT_JOBS = int(os.getenv("PIPELINE_ENDPOINT_JOBS", 0))
+# group the work units of a "source" or "destination" into multi-transfer
+# FTS jobs, "none" submits one job per work unit
+FTS_JOB_GROUP_BY = os.getenv("FTS_JOB_GROUP_BY", "none")
+# maximum number of transfers in a grouped FTS job
+FTS_JOB_MAX_TRANSFERS = int(os.getenv("FTS_JOB_MAX_TRANSFERS", 100))
+# order the work units are submitted in: "latin" spreads every round over
+# all endpoints, "permutation" keeps the configuration order
+PIPELINE_ORDER = os.getenv("PIPELINE_ORDER", "latin")
+# FTS jobs per minute and endpoint (as source or destination), 0 for no limit
+PIPELINE_ENDPOINT_RATE = float(os.getenv("PIPELINE_ENDPOINT_RATE", 0))
+# jobs an endpoint may get at once before its rate applies
+PIPELINE_ENDPOINT_BURST = int(os.getenv("PIPELINE_ENDPOINT_BURST", 2))
+# seconds a submission is assumed to take by --simulate
+SIMULATE_SUBMIT_SECONDS = float(os.getenv("SIMULATE_SUBMIT_SECONDS", 1))
+# adaptive runs stop repeating a link once the 95% confidence interval of
+# its throughput is within this fraction of the mean
+ADAPTIVE_CI = float(os.getenv("FTS_ADAPTIVE_CI", 0.1))
+# finished files a link needs before it can be stable
+ADAPTIVE_MIN_SAMPLES = int(os.getenv("FTS_ADAPTIVE_MIN_SAMPLES", 3))
+# MB an adaptive run may transfer, 0 for no limit
+ADAPTIVE_BUDGET_MB = int(os.getenv("FTS_ADAPTIVE_BUDGET_MB", 0))
+# two-sided 95% Student t quantiles by degrees of freedom (1-10)
+_T95 = (12.71, 4.30, 3.18, 2.78, 2.57, 2.45, 2.36, 2.31, 2.26, 2.23)
+
+_STAGE_STOP = object()
+
+
+class _EndpointLimiter(object):
+    """
+    Bound the number of concurrent operations per endpoint
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def acquire(self, endpoints):
+        """
+        Take a slot at every endpoint (in sorted order, so never deadlocks)
+        """
+        if not self.limit:
+            return
+        for endpoint in sorted(set(endpoints)):
+            with self.lock:
+                semaphore = self.semaphores.setdefault(
+                    endpoint, threading.BoundedSemaphore(self.limit))
+            semaphore.acquire()
+
+    def release(self, endpoints):
+        """
+        Give back the slots taken by acquire
+        """
+        if not self.limit:
+            return
+        for endpoint in sorted(set(endpoints)):
+            self.semaphores[endpoint].release()
+
+
+def _order_units(units, policy=PIPELINE_ORDER):
+    """
+    Order work units for submission
+
+    "latin" orders the pairs of every protocol as a round-robin Latin
+    square: in round r endpoint i sends to endpoint i + r, so each round
+    uses every endpoint once as source and once as destination. Repeated
+    pairs (jobs, filesizes, numfiles) come in later layers of rounds.
+    "permutation" keeps the order of the plan.
+
+    Returns:
+        List of work units
+    """
+    if policy == "permutation":
+        return list(units)
+    # endpoint position per protocol, in order of appearance
+    positions = {}
+    for unit in units:
+        for url in (unit.source_url, unit.dest_url):
+            protocol = url.split("://", 1)[0]
+            endpoints = positions.setdefault(protocol, {})
+            endpoints.setdefault(url, len(endpoints))
+    protocols = dict(
+        (protocol, index) for index, protocol in enumerate(positions))
+    layers = {}
+    keys = []
+    for unit in units:
+        protocol = unit.source_url.split("://", 1)[0]
+        endpoints = positions[protocol]
+        source = endpoints[unit.source_url]
+        rotation = (endpoints[unit.dest_url] - source) % len(endpoints)
+        pair = (unit.source_url, unit.dest_url)
+        layer = layers.get(pair, 0)
+        layers[pair] = layer + 1
+        keys.append((layer, rotation, source, protocols[protocol]))
+    return [unit for _, unit in sorted(zip(keys, units), key=lambda x: x[0])]
+
+
+class _TokenBucket(object):
+    """
+    Token bucket of rate tokens per second holding at most burst tokens
+    """
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = now
+
+    def available(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def wait(self, now):
+        """
+        Seconds until a token is available
+        """
+        return max(0.0, (1 - self.available(now)) / self.rate)
+
+
+def _batch_endpoints(batch):
+    """
+    Sorted storage endpoints a batch of work units reads from or writes to
+    """
+    return sorted(
+        set(
+            _gfal_endpoint(unit[key])
+            for unit in batch
+            for key in ('source_url', 'dest_url')))
+
+
+class _Interleaver(object):
+    """
+    Hand out batches of work units by rank, as endpoint rates allow
+
+    The rank of a batch is the lowest rank of its units. pop() returns the
+    lowest ranked batch whose endpoints all have a token left (see
+    PIPELINE_ENDPOINT_RATE), so an endpoint at its rate does not hold up
+    the batches of other endpoints. Time is passed in, so that --simulate
+    can run it on a virtual clock.
+    """
+
+    def __init__(self,
+                 rate=PIPELINE_ENDPOINT_RATE,
+                 burst=PIPELINE_ENDPOINT_BURST):
+        # per second
+        self.rate = rate / 60.0
+        self.burst = max(1, burst)
+        self.buckets = {}
+        # sorted (rank, sequence, batch)
+        self.pending = []
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, batch):
+        rank = min(unit['rank'] for unit in batch)
+        bisect.insort(self.pending, (rank, next(self.sequence), batch))
+
+    def _buckets(self, batch, now):
+        buckets = []
+        for endpoint in _batch_endpoints(batch):
+            if endpoint not in self.buckets:
+                self.buckets[endpoint] = _TokenBucket(self.rate, self.burst,
+                                                      now)
+            buckets.append(self.buckets[endpoint])
+        return buckets
+
+    def pop(self, now):
+        """
+        Return the next batch to submit, None if none may go yet
+        """
+        for index, (_, _, batch) in enumerate(self.pending):
+            if self.rate:
+                buckets = self._buckets(batch, now)
+                if any(bucket.available(now) < 1 for bucket in buckets):
+                    continue
+                for bucket in buckets:
+                    bucket.tokens -= 1
+            del self.pending[index]
+            return batch
+        return None
+
+    def wait(self, now):
+        """
+        Seconds until pop() may return a batch, None if nothing is pending
+        """
+        if not self.pending:
+            return None
+        if not self.rate:
+            return 0.0
+        return min(
+            max(bucket.wait(now)
+                for bucket in self._buckets(batch, now))
+            for _, _, batch in self.pending)
+
+
+class _InterleavingStage(object):
+    """
+    Pass batches downstream by rank, under the endpoint rates
+
+    Batches wait here while the downstream queue is full, so the lowest
+    ranked one goes first once a submit worker is free.
+    """
+
+    def __init__(self, downstream):
+        self.downstream = downstream
+        self.interleaver = _Interleaver()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, batch):
+        with self.condition:
+            self.interleaver.add(batch)
+            self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def join(self):
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                batch = self.interleaver.pop(time.time())
+                if batch is None:
+                    if self.closed and not self.interleaver:
+                        break
+                    timeout = self.interleaver.wait(time.time())
+                    if timeout is not None:
+                        timeout = max(timeout, 0.01)
+                    self.condition.wait(timeout)
+                    continue
+            self.downstream.put(batch)
+        self.downstream.close()
+
+
+class _Stage(object):
+    """
+    A pool of threads applying func to the items of a bounded queue
+
+    func returns the items to hand to the downstream stage (an object with
+    put() and close()). When the stage is closed and its last worker exits,
+    the downstream stage is closed in turn.
+    """
+
+    def __init__(self, name, func, workers, downstream=None):
+        self.name = name
+        self.func = func
+        self.downstream = downstream
+        self.inbox = Queue.Queue(PIPELINE_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.alive = max(1, workers)
+        self.threads = []
+        for _ in xrange(self.alive):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def put(self, item):
+        self.inbox.put(item)
+
+    def close(self):
+        for _ in self.threads:
+            self.inbox.put(_STAGE_STOP)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            item = self.inbox.get()
+            if item is _STAGE_STOP:
+                break
+            try:
+                for output in self.func(item) or []:
+                    self.downstream.put(output)
+            except Exception as e:
+                _flush_logging_msg("{} stage failed:{}".format(self.name, e))
+        with self.lock:
+            self.alive -= 1
+            last = self.alive == 0
+        if last and self.downstream is not None:
+            self.downstream.close()
+
+
+class _GroupingStage(object):
+    """
+    Collect work units into batches that are submitted as one FTS job
+
+    Units are grouped by source or destination URL (and by checksum mode,
+    which is a job-wide setting) until a batch holds max_transfers files;
+    remaining partial batches are flushed when the stage is closed.
+    """
+
+    def __init__(self, group_by, max_transfers, downstream):
+        self.group_by = group_by
+        self.max_transfers = max_transfers
+        self.downstream = downstream
+        self.lock = threading.Lock()
+        # group key -> list of units
+        self.batches = OrderedDict()
+
+    def put(self, unit):
+        if self.group_by == "none":
+            self.downstream.put([unit])
+            return
+        key = (unit[{
+            'source': 'source_url',
+            'destination': 'dest_url'
+        }[self.group_by]], unit['checksum'])
+        full = None
+        with self.lock:
+            batch = self.batches.setdefault(key, [])
+            if batch and sum(u['numfile'] for u in batch) + \
+                    unit['numfile'] > self.max_transfers:
+                full = self.batches.pop(key)
+                batch = self.batches.setdefault(key, [])
+            batch.append(unit)
+        if full:
+            self.downstream.put(full)
+
+    def close(self):
+        with self.lock:
+            batches = list(self.batches.values())
+            self.batches.clear()
+        for batch in batches:
+            self.downstream.put(batch)
+        self.downstream.close()
+
+
+class _PollStage(object):
+    """
+    Downstream end of the pipeline: polls and purges the submitted jobs
+    """
+
+    def __init__(self, on_finished, results=None, checkpoint=None):
+        self.incoming = Queue.Queue()
+        self.deleter = _Deleter()
+        self.thread = threading.Thread(target=_fts_wait_jobs_in_thread,
+                                       args=(self.incoming, self.deleter,
+                                             on_finished, results, checkpoint))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, job_map):
+        self.incoming.put(job_map)
+
+    def close(self):
+        self.incoming.put(None)
+
+    def join(self):
+        self.thread.join()
+        self.deleter.close()
+
+
+def _fts_wait_jobs_in_thread(incoming, deleter, on_finished, results,
+                             checkpoint):
+    _fts_wait_jobs(_fts_context(), [],
+                   deleter=deleter,
+                   incoming=incoming,
+                   on_finished=on_finished,
+                   results=results,
+                   checkpoint=checkpoint)
+
+
+# endpoint without protocol: host[:port]/path
+_ENDPOINT_RE = re.compile(r"^([^:/]+)(?::[0-9]*)?(/.*)?$")
+
+CHECKSUM_MODES = ("none", "source", "target", "both")
+
+_WorkUnit = namedtuple("_WorkUnit",
+                       "source_url dest_url filesize numfile checksum")
+
+_Plan = namedtuple(
+    "_Plan", "endpoints units testing_folder overwrite metadata deadlines")
+
+
+def _config_list(data, key):
+    values = data[key]
+    if not isinstance(values, list) or not values or not all(
+            isinstance(value, int) and value > 0 for value in values):
+        raise ValueError("{} must be a list of positive integers".format(key))
+    return values
+
+
+def _compile_plan(data):
+    """
+    Compile a test configuration into an immutable run plan
+
+    Endpoints are validated and the ones to set up are deduplicated on
+    host and path (the same storage behind several protocols or ports is
+    set up once). Every (pair, filesize, numfile) combination of every job
+    becomes a work unit with its URLs and checksum mode resolved, in
+    submission order.
+
+    Per-endpoint settings go into the optional "endpoint_overrides" map of
+    the configuration, keyed by endpoint as listed under "protocols":
+    "checksum" replaces the checksum mode of the pairs the endpoint is the
+    source of (or the destination of, if the source has none), "timeout"
+    the seconds its setup may take.
+
+    Args:
+        data(dict): Parsed JSON configuration
+
+    Returns:
+        _Plan
+
+    Raises:
+        ValueError: on an invalid configuration
+    """
+    try:
+        protocol_map = data['protocols']
+        num_of_files_list = _config_list(data, 'num_of_files')
+        filesize_list = _config_list(data, 'filesizes')
+        num_of_jobs = int(data['num_of_jobs'])
+        testing_folder = data['testing_folder']
+        checksum = data['checksum']
+        overwrite = bool(data['overwrite'])
+        metadata = data['metadata']
+    except KeyError as e:
+        raise ValueError("missing setting {}".format(e))
+    overrides = data.get('endpoint_overrides', {})
+    if not isinstance(overrides, dict):
+        raise ValueError("endpoint_overrides must be a map")
+    if checksum not in CHECKSUM_MODES:
+        raise ValueError("unknown checksum mode {}".format(checksum))
+
+    endpoints = []
+    seen = set()
+    known = set()
+    for protocol in protocol_map:
+        for endpoint in protocol_map[protocol]:
+            # example: endpoint = door05.pic.es:8452//rucio/pic_dcache
+            match = _ENDPOINT_RE.match(endpoint)
+            if not match:
+                raise ValueError("invalid endpoint {}".format(endpoint))
+            known.add(endpoint)
+            # example: key = door05.pic.es//rucio/pic_dcache
+            key = match.group(1) + (match.group(2) or "")
+            if key not in seen:
+                seen.add(key)
+                endpoints.append("{}://{}".format(protocol, endpoint))
+
+    deadlines = {}
+    for endpoint, override in overrides.items():
+        if endpoint not in known:
+            raise ValueError(
+                "override for unknown endpoint {}".format(endpoint))
+        if not isinstance(override, dict):
+            raise ValueError("override for {} must be a map".format(endpoint))
+        if override.get('checksum', checksum) not in CHECKSUM_MODES:
+            raise ValueError("unknown checksum mode {} for {}".format(
+                override['checksum'], endpoint))
+        if 'timeout' in override:
+            timeout = override['timeout']
+            if (isinstance(timeout, bool) or
+                    not isinstance(timeout,
+                                   (int, long, float)) or timeout <= 0):
+                raise ValueError("invalid timeout {!r} for {}".format(
+                    timeout, endpoint))
+            for protocol in protocol_map:
+                if endpoint in protocol_map[protocol]:
+                    deadlines["{}://{}".format(protocol, endpoint)] = timeout
+
+    units = []
+    for _ in xrange(num_of_jobs):
+        for protocol in protocol_map:
+            urls = [(endpoint, "{}://{}".format(protocol, endpoint))
+                    for endpoint in protocol_map[protocol]]
+            # create unique pairs of 2s (source destination)
+            for (source, source_url), (dest, dest_url) in \
+                    itertools.permutations(urls, 2):
+                pair_checksum = overrides.get(source, {}).get(
+                    'checksum',
+                    overrides.get(dest, {}).get('checksum', checksum))
+                for filesize in filesize_list:
+                    for numfile in num_of_files_list:
+                        units.append(
+                            _WorkUnit(source_url, dest_url, filesize, numfile,
+                                      pair_checksum))
+    return _Plan(tuple(endpoints), tuple(units), testing_folder, overwrite,
+                 metadata, deadlines)
+
+
+def _select_units(units, prob_endpoints, shard=None):
+    """
+    Work units of the plan this process runs
+
+    The units of the whole mesh are split into shards before the problematic
+    sources are dropped, so every shard of a run gets the same assignment
+    whatever its own endpoint setup found.
+
+    Args:
+        units(tuple): Work units of the plan
+        prob_endpoints(list): Problematic endpoints (without protocol)
+        shard(tuple): (index, count) to keep only the units of one shard
+
+    Returns:
+        List of work units, in submission order
+    """
+    if shard is not None:
+        units = _shard_units(units, *shard)
+
+    # if the source endpoint is faulty, abort this run
+    prob_endpoints = set(prob_endpoints)
+    aborted = set()
+    kept = []
+    for unit in units:
+        source = unit.source_url.split("://", 1)[1]
+        if source not in prob_endpoints:
+            kept.append(unit)
+        elif source not in aborted:
+            aborted.add(source)
+            _flush_logging_msg("Aborting run for source: {}".format(source))
+    return kept
+
+
+def _print_plan(plan, units):
+    """
+    Print the work units of a plan and its size
+    """
+    print("{:<60} {:<60} {:>6} {:>5} {:>8}".format("source", "destination",
+                                                   "MB", "files", "checksum"))
+    for unit in units:
+        print("{:<60} {:<60} {:>6} {:>5} {:>8}".format(unit.source_url,
+                                                       unit.dest_url,
+                                                       unit.filesize,
+                                                       unit.numfile,
+                                                       unit.checksum))
+    print("{} endpoints to set up, {} FTS jobs, {} transfers, {} MB".format(
+        len(plan.endpoints), len(units), sum(unit.numfile for unit in units),
+        sum(unit.numfile * unit.filesize for unit in units)))
+
+
+class _Collector(object):
+    """
+    Downstream stage keeping the items it is given
+    """
+
+    def __init__(self):
+        self.items = []
+
+    def put(self, item):
+        self.items.append(item)
+
+    def close(self):
+        pass
+
+
+def _simulate_schedule(units, group_by, max_transfers, throughput):
+    """
+    Replay the submission of work units on a virtual clock
+
+    Units are batched as by the pipeline, handed out by an _Interleaver to
+    PIPELINE_SUBMIT_WORKERS workers taking SIMULATE_SUBMIT_SECONDS per
+    submission under the PIPELINE_ENDPOINT_JOBS limit, and every job runs
+    for its _fts_job_estimate. No storage or FTS call is made.
+
+    Args:
+        units(list): Work units, in submission order
+        group_by(str): Grouping of the units into FTS jobs
+        max_transfers(int): Maximum number of transfers in an FTS job
+        throughput(dict): {(source_se, dest_se): MB/s}
+
+    Returns:
+        Dict with the makespan in seconds and, per endpoint, the number of
+        jobs and the peak number of concurrent jobs as source, as
+        destination and in total
+    """
+    collector = _Collector()
+    grouping = _GroupingStage(group_by, max_transfers, collector)
+    for rank, unit in enumerate(units):
+        grouping.put(dict(unit._asdict(), rank=rank))
+    grouping.close()
+    interleaver = _Interleaver()
+    for batch in collector.items:
+        interleaver.add(batch)
+
+    endpoints = {}
+    active = {}
+    # (finish time, sequence, job)
+    running = []
+    sequence = itertools.count()
+    # per worker: time it is free, batch it waits to submit
+    workers = [[0.0, None] for _ in xrange(max(1, PIPELINE_SUBMIT_WORKERS))]
+    now = 0.0
+    while interleaver or running or any(batch for _, batch in workers):
+        while running and running[0][0] <= now:
+            _, _, job = heapq.heappop(running)
+            for endpoint, roles in job.items():
+                for role in roles:
+                    active[endpoint, role] -= 1
+        for worker in workers:
+            if worker[0] <= now and worker[1] is None:
+                worker[1] = interleaver.pop(now)
+        for worker in workers:
+            batch = worker[1]
+            if batch is None or worker[0] > now:
+                continue
+            # endpoint -> roles of the endpoint in the job
+            job = {}
+            for unit in batch:
+                job.setdefault(_gfal_endpoint(unit['source_url']),
+                               set(['total'])).add('source')
+                job.setdefault(_gfal_endpoint(unit['dest_url']),
+                               set(['total'])).add('destination')
+            if PIPELINE_ENDPOINT_JOBS and any(
+                    active.get((endpoint, 'total'), 0) >= PIPELINE_ENDPOINT_JOBS
+                    for endpoint in job):
+                continue
+            worker[0] = now + SIMULATE_SUBMIT_SECONDS
+            worker[1] = None
+            links = [{
+                'source': unit['source_url'],
+                'destination': unit['dest_url'],
+                'filesize': unit['filesize'],
+                'numfile': unit['numfile']
+            } for unit in batch]
+            finish = worker[0] + _fts_job_estimate({'links': links}, throughput)
+            heapq.heappush(running, (finish, next(sequence), job))
+            for endpoint, roles in job.items():
+                stats = endpoints.setdefault(endpoint, {
+                    'jobs': 0,
+                    'source': 0,
+                    'destination': 0,
+                    'total': 0
+                })
+                stats['jobs'] += 1
+                for role in roles:
+                    active[endpoint, role] = active.get((endpoint, role), 0) + 1
+                    stats[role] = max(stats[role], active[endpoint, role])
+        events = [running[0][0]] if running else []
+        events += [free for free, waiting in workers if free > now]
+        if interleaver and any(
+                free <= now and batch is None for free, batch in workers):
+            events.append(now + max(interleaver.wait(now), 0.01))
+        if not events:
             break
-        except fts3_client_exceptions.ClientError as e:
-            _flush_logging_msg(e)
-            return -1
+        now = min(events)
+    return {'makespan': now, 'endpoints': endpoints}
 
-    return job_id
+
+def _print_simulation(simulation, policy):
+    """
+    Print the peak concurrent FTS jobs per endpoint of a simulated run
+    """
+    endpoints = simulation['endpoints']
+    print("{:<60} {:>5} {:>7} {:>12} {:>6}".format("endpoint", "jobs", "source",
+                                                   "destination", "total"))
+    for endpoint in sorted(endpoints):
+        stats = endpoints[endpoint]
+        print("{:<60} {:>5} {:>7} {:>12} {:>6}".format(endpoint, stats['jobs'],
+                                                       stats['source'],
+                                                       stats['destination'],
+                                                       stats['total']))
+    peaks = [peak['total'] for peak in endpoints.values()] or [0]
+    print("{} order: peak {} concurrent jobs at an endpoint "
+          "(mean peak {:.1f}), makespan {:.0f}s".format(
+              policy, max(peaks),
+              sum(peaks) / float(len(peaks)), simulation['makespan']))
+
+
+def _throughput_stable(mbps):
+    """
+    Whether throughput samples pin down the mean of a link (ADAPTIVE_CI)
+    """
+    count = len(mbps)
+    if count < max(2, ADAPTIVE_MIN_SAMPLES):
+        return False
+    mean = sum(mbps) / float(count)
+    if mean <= 0:
+        return False
+    variance = sum((x - mean)**2 for x in mbps) / (count - 1)
+    quantile = _T95[count - 2] if count - 1 <= len(_T95) else 1.96
+    return quantile * (variance / count)**0.5 <= ADAPTIVE_CI * mean
+
+
+class _AdaptiveSampler(object):
+    """
+    Hand out the repetitions of the links of an adaptive run
+
+    The configuration repeats every (pair, filesize, numfile) combination
+    num_of_jobs times. Every link starts with its first repetition; each
+    time a job of the link finishes, its next repetition is handed out
+    only if the link failed during this run or its throughput (over the
+    last FTS_POLL_HISTORY hours, this run included) is not stable yet.
+    Links go on independently of each other. Repetitions that would take
+    the run beyond its budget are dropped.
+    """
+
+    def __init__(self, units, results, budget_mb=ADAPTIVE_BUDGET_MB):
+        self.results = results
+        self.budget_mb = budget_mb
+        self.spent_mb = 0
+        self.skipped = 0
+        self.lock = threading.Lock()
+        # (source_url, dest_url, filesize, numfile) -> [(rank, unit)]
+        self.links = OrderedDict()
+        for rank, unit in enumerate(units):
+            self.links.setdefault(unit[:4], []).append((rank, unit))
+
+    def _take(self, repetitions):
+        rank, unit = repetitions[0]
+        size_mb = unit.filesize * unit.numfile
+        if self.budget_mb and self.spent_mb + size_mb > self.budget_mb:
+            self.skipped += len(repetitions)
+            del repetitions[:]
+            return None
+        self.spent_mb += size_mb
+        del repetitions[0]
+        return rank, unit
+
+    def first(self):
+        """
+        First repetition of every link, as (rank, work unit) pairs
+        """
+        with self.lock:
+            taken = [
+                self._take(repetitions) for repetitions in self.links.values()
+            ]
+        return [ranked for ranked in taken if ranked is not None]
+
+    def finished(self, link):
+        """
+        Next repetition of a link whose job finished, None once it is done
+
+        Args:
+            link(dict): Link of the job map (source, destination, filesize,
+                numfile)
+
+        Returns:
+            (rank, work unit) or None
+        """
+        key = (link['source'], link['destination'], link['filesize'],
+               link['numfile'])
+        with self.lock:
+            repetitions = self.links.get(key)
+            if not repetitions:
+                return None
+            endpoints = (_gfal_endpoint(link['source']),
+                         _gfal_endpoint(link['destination']))
+            samples = self.results.link_samples(
+                time.time() - FTS_POLL_HISTORY * 3600, self.results.run_id,
+                endpoints).get(endpoints + (link['filesize'] * MB,), {})
+            if not samples.get('failed') and _throughput_stable(
+                    samples.get('mbps', [])):
+                _flush_logging_msg(
+                    "Link {} -> {} ({}MB) is stable, skipping {} more "
+                    "FTS jobs".format(link['source'], link['destination'],
+                                      link['filesize'], len(repetitions)))
+                self.skipped += len(repetitions)
+                del repetitions[:]
+                return None
+            return self._take(repetitions)
+
+
+def _shard_units(units, index, count):
+    """
+    Deterministically keep the work units of one shard out of count
+
+    Units sharing a source stay together, so the pool of a source is
+    checked and topped up by a single shard. Groups are handed out largest
+    first to the least loaded shard.
+    """
+    groups = OrderedDict()
+    for unit in units:
+        groups.setdefault(unit.source_url, []).append(unit)
+    load = [0] * count
+    keys = set()
+    for key in sorted(groups, key=lambda key: -len(groups[key])):
+        target = load.index(min(load))
+        load[target] += len(groups[key])
+        if target == index:
+            keys.add(key)
+    return [unit for unit in units if unit.source_url in keys]
+
+
+def _shard_path(path, shard):
+    """
+    Per-shard variant of a state file: results.sqlite -> results.1-of-4.sqlite
+    """
+    if not path or shard is None:
+        return path
+    base, ext = os.path.splitext(path)
+    return "{}.{}-of-{}{}".format(base, shard[0], shard[1], ext)
+
+
+def _parse_shard(value):
+    """
+    argparse type of --shard: "i/N" -> (i, N)
+    """
+    try:
+        index, count = [int(part) for part in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, got {}".format(value))
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(
+            "shard index must be in [0, N), got {}".format(value))
+    return index, count
+
+
+def _run_shards(argv, processes, run_id):
+    """
+    Local launcher: run every shard of the run in its own worker process
+
+    Each worker re-runs this script with --shard i/N (so it has its own gfal2
+    and FTS contexts) and writes to its own results database, which is
+    merged into the main one once the worker exits. The endpoints are set
+    up by the launcher beforehand; argv passes the outcome on to the workers
+    (--skip-setup, --problematic).
+
+    Returns:
+        Number of workers that failed
+    """
+    script = os.path.abspath(__file__)
+    workers = []
+    for index in xrange(processes):
+        shard = (index, processes)
+        env = dict(os.environ)
+        env["FTS_RESULTS_DB"] = _shard_path(RESULTS_DB, shard)
+        if METRICS_PORT:
+            env["FTS_METRICS_PORT"] = str(METRICS_PORT + 1 + index)
+        if METRICS_TEXTFILE:
+            env["FTS_METRICS_TEXTFILE"] = _shard_path(METRICS_TEXTFILE, shard)
+        command = [sys.executable, script] + argv + [
+            "--shard", "{}/{}".format(index, processes), "--run-id", run_id
+        ]
+        _flush_logging_msg("Starting shard {}/{}".format(index, processes))
+        workers.append(
+            (shard, env["FTS_RESULTS_DB"], subprocess.Popen(command, env=env)))
+
+    failed = 0
+    results = _ResultsStore(run_id=run_id)
+    for shard, results_db, worker in workers:
+        code = worker.wait()
+        if code:
+            failed += 1
+            _flush_logging_msg("Shard {}/{} exited with code {}".format(
+                shard[0], shard[1], code))
+        if os.path.isfile(results_db):
+            merged = results.merge(results_db)
+            os.remove(results_db)
+            _flush_logging_msg("Merged {} results of shard {}/{}".format(
+                merged, shard[0], shard[1]))
+    return failed
+
+
+def _strip_option(argv, option):
+    """
+    Remove a valued option (--opt X or --opt=X) from an argument list
+    """
+    stripped = []
+    skip = False
+    for argument in argv:
+        if skip:
+            skip = False
+        elif argument == option:
+            skip = True
+        elif not argument.startswith(option + "="):
+            stripped.append(argument)
+    return stripped
+
+
+def _unit_count(item):
+    """
+    Number of work units carried by an item of a pipeline stage
+    """
+    if isinstance(item, list):
+        # group of (rank, unit) or batch of units
+        return len(item)
+    if 'group' in item:
+        # upload of a group
+        return len(item['group'])
+    if 'links' in item:
+        # job map
+        return len(item['links'])
+    return 1
+
+
+class _Pipeline(object):
+    """
+    Run work units through prepare -> upload -> submit -> poll stages
+
+    Args:
+        testing_folder(str): Folder of the test files at every endpoint
+        overwrite(bool): Overwrite existing destination files
+        metadata(str): Job metadata passed to FTS
+        payload_cache(_PayloadCache): Generated files reused across pairs
+        group_by(str): Grouping of the units into FTS jobs
+        max_transfers(int): Maximum number of transfers in an FTS job
+        results(_ResultsStore): Store of the per-file results
+        checkpoint(_Checkpoint): Submitted jobs kept for --resume
+        source_pool(_SourcePool): Source files available at every endpoint
+        sampler(_AdaptiveSampler): Next repetitions of an adaptive run
+    """
+
+    def __init__(self,
+                 testing_folder,
+                 overwrite,
+                 metadata,
+                 payload_cache,
+                 group_by=FTS_JOB_GROUP_BY,
+                 max_transfers=FTS_JOB_MAX_TRANSFERS,
+                 results=None,
+                 checkpoint=None,
+                 source_pool=None,
+                 sampler=None):
+        self.group_by = group_by
+        self.sampler = sampler
+        self.results = results
+        self.checkpoint = checkpoint
+        self.max_transfers = max_transfers
+        self.testing_folder = testing_folder
+        self.overwrite = overwrite
+        self.metadata = metadata
+        self.payload_cache = payload_cache
+        self.source_pool = source_pool or _SourcePool()
+        self.seed_only = False
+        self.storage_ops = _EndpointLimiter(PIPELINE_ENDPOINT_OPS)
+        self.fts_jobs = _EndpointLimiter(PIPELINE_ENDPOINT_JOBS)
+        self.aborted_sources = set()
+        self.job_map_list = []
+        self.prepare = None
+        # work units in flight, with a sampler
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+
+    def run(self, units, seed_only=False):
+        """
+        Push the work units through the pipeline and wait until all are done
+
+        Args:
+            units(list): Work units, in submission order
+            seed_only(bool): Only top up the source pools, submit nothing
+
+        Returns:
+            List of the job maps of the submitted jobs
+        """
+        self.seed_only = seed_only
+        track = self.sampler is not None and not seed_only
+        if track:
+            ranked = self.sampler.first()
+        else:
+            ranked = list(enumerate(units))
+        groups = OrderedDict()
+        for rank, unit in ranked:
+            groups.setdefault((unit.source_url, unit.filesize), []).append(
+                (rank, unit))
+
+        stages = []
+        grouping = None
+        if not seed_only:
+            poll = _PollStage(self._job_finished, self.results, self.checkpoint)
+            submit = _Stage("submit", self._stage_func(self._submit, track),
+                            PIPELINE_SUBMIT_WORKERS, poll)
+            interleaving = _InterleavingStage(submit)
+            grouping = _GroupingStage(self.group_by, self.max_transfers,
+                                      interleaving)
+            stages = [interleaving, submit, poll]
+        upload = _Stage("upload", self._stage_func(self._upload, track),
+                        PIPELINE_UPLOAD_WORKERS, grouping)
+        prepare = _Stage("prepare", self._stage_func(self._prepare, track),
+                         PIPELINE_PREPARE_WORKERS, upload)
+        self.prepare = prepare
+        if track and groups:
+            self._feed(list(groups.values()))
+        else:
+            for group in groups.values():
+                prepare.put(group)
+            prepare.close()
+        for stage in [prepare, upload] + stages:
+            stage.join()
+        return self.job_map_list
+
+    @staticmethod
+    def _hub_targets(units, hubs):
+        """
+        Seeding needs of the sources of hubs
+
+        Returns:
+            Tuple ({(hub, source, filesize): work unit needing the most
+            files}, {(hub, filesize): files the hub must hold})
+        """
+        targets = OrderedDict()
+        for unit in units:
+            hub_url = hubs.get(unit.source_url.split("://", 1)[0])
+            if hub_url is None:
+                continue
+            key = (hub_url, unit.source_url, unit.filesize)
+            if key not in targets or unit.numfile > targets[key].numfile:
+                targets[key] = unit
+        needed = OrderedDict()
+        for (hub_url, _, filesize), unit in targets.items():
+            key = (hub_url, filesize)
+            needed[key] = max(needed.get(key, 0), unit.numfile)
+        return targets, needed
+
+    def top_up_hubs(self, units, hubs):
+        """
+        Upload the files the hubs lack from the submit host
+
+        The pool of a hub is topped up once per filesize, to the largest
+        number of files a source of its protocol needs. Called by the
+        launcher before the shards start, so that a hub is topped up once.
+
+        Args:
+            units(list): Work units
+            hubs(dict): {protocol: hub URL}, hubs being sources of the plan
+        """
+        for (hub_url, filesize), numfile in \
+                self._hub_targets(units, hubs)[1].items():
+            _flush_logging_msg("Topping up hub {} with {} {}MB files".format(
+                hub_url, numfile, filesize))
+            group = [(0, _WorkUnit(hub_url, hub_url, filesize, numfile,
+                                   "none"))]
+            for upload in self._prepare(group):
+                self._upload(upload)
+
+    def replicate(self, units, hubs, top_up=True):
+        """
+        Seed the source pools from hub endpoints by third-party copies
+
+        Unless top_up is False (the launcher of the shards did it), the
+        hubs are first topped up (see top_up_hubs). Then one FTS job per
+        source copies the files the source lacks from the hub's src/
+        directory into its own, all jobs running at once. A source whose
+        copies fail keeps its gaps, which the upload stage fills from the
+        submit host.
+
+        Args:
+            units(list): Work units
+            hubs(dict): {protocol: hub URL}, hubs being sources of the plan
+            top_up(bool): Top up the hubs first
+        """
+        if top_up:
+            self.top_up_hubs(units, hubs)
+        targets, needed = self._hub_targets(units, hubs)
+
+        hub_files = {}
+        for (hub_url, filesize), numfile in needed.items():
+            if hub_url in self.aborted_sources:
+                continue
+            hub_dir = os.path.join(hub_url, self.testing_folder, "src")
+            selected = self.source_pool.select(hub_dir, filesize, numfile)
+            if selected != -1:
+                hub_files[hub_url, filesize] = selected
+
+        job_map_list = []
+        for (hub_url, source_url, filesize), unit in targets.items():
+            if source_url == hub_url or (hub_url, filesize) not in hub_files:
+                continue
+            source_dir = os.path.join(source_url, self.testing_folder, "src")
+            endpoints = [_gfal_endpoint(source_url)]
+            self.storage_ops.acquire(endpoints)
+            try:
+                selected = self.source_pool.select(source_dir, filesize, None)
+            finally:
+                self.storage_ops.release(endpoints)
+            if selected == -1:
+                continue
+            hub_filenames, checksums = hub_files[hub_url, filesize]
+            filenames = [
+                filename for filename in hub_filenames
+                if filename not in selected[0]
+            ][:unit.numfile - len(selected[0])]
+            if not filenames:
+                continue
+            metadata = dict(self.metadata)
+            metadata['seed'] = hub_url
+            _flush_logging_msg("Copying {} {}MB files from {} to {}".format(
+                len(filenames), filesize, hub_url, source_url))
+            job_id = _fts_submit_job(hub_url,
+                                     source_url,
+                                     filenames,
+                                     filenames,
+                                     unit.checksum,
+                                     False,
+                                     self.testing_folder,
+                                     _fts_context(),
+                                     metadata,
+                                     checksums,
+                                     src_folder="src",
+                                     dest_folder="src")
+            if job_id == -1:
+                continue
+            job_map_list.append({
+                'job_id': job_id,
+                'links': [{
+                    'source': hub_url,
+                    'destination': source_url,
+                    'filesize': filesize,
+                    'numfile': len(filenames)
+                }],
+                'purge': {},
+                'submitted': time.time(),
+                'seed': (source_dir, filesize, checksums)
+            })
+        if not job_map_list:
+            return
+
+        _fts_wait_jobs(_fts_context(), job_map_list)
+        for job_map in job_map_list:
+            source_dir, filesize, checksums = job_map['seed']
+            try:
+                files = _fts_get_job_files(_fts_context(), job_map['job_id'])
+            except Exception as e:
+                _flush_logging_msg("Seeding job {} unknown:{}".format(
+                    job_map['job_id'], e))
+                continue
+            copied = dict(
+                (filename, checksums.get(filename))
+                for filename in (os.path.basename(file_map['dest_surl'])
+                                 for file_map in files
+                                 if file_map['file_state'] == "FINISHED"))
+            _flush_logging_msg("Seeded {}/{} files of {}".format(
+                len(copied), len(files), source_dir))
+            _listing_cache.add(source_dir, list(copied))
+            self.source_pool.add(source_dir, filesize, copied)
+
+    def _stage_func(self, func, track):
+        """
+        Wrap a stage function to count the work units it drops, if tracked
+        """
+        if not track:
+            return func
+
+        def _counted(item):
+            outputs = []
+            try:
+                outputs = func(item) or []
+            finally:
+                dropped = _unit_count(item) - sum(
+                    _unit_count(output) for output in outputs)
+                if dropped:
+                    self._settle(dropped)
+            return outputs
+
+        return _counted
+
+    def _feed(self, groups):
+        """
+        Put groups of (rank, unit) into the prepare stage, counted in flight
+        """
+        with self.in_flight_lock:
+            self.in_flight += sum(len(group) for group in groups)
+        for group in groups:
+            self.prepare.put(group)
+
+    def _settle(self, count):
+        """
+        Count work units out of the pipeline, closing it when none is left
+        """
+        with self.in_flight_lock:
+            self.in_flight -= count
+            done = self.in_flight == 0
+        if done:
+            self.prepare.close()
+
+    def _abort(self, source_url):
+        _flush_logging_msg("Aborting run for source: {}".format(source_url))
+        self.aborted_sources.add(source_url)
+
+    def _prepare(self, group):
+        """
+        Check the source of a group and generate the files it lacks
+        """
+        source_url = group[0][1].source_url
+        filesize = group[0][1].filesize
+        if source_url in self.aborted_sources:
+            return []
+        numfile = max(unit.numfile for _, unit in group)
+        source_dir = os.path.join(source_url, self.testing_folder, "src")
+
+        # check if source has adequate number of files of the desired filesize
+        _flush_logging_msg("Checking {} for {} existing {}MB files".format(
+            source_url, numfile, filesize))
+        endpoints = [_gfal_endpoint(source_url)]
+        self.storage_ops.acquire(endpoints)
+        try:
+            with _phase("check"):
+                selected = self.source_pool.select(source_dir, filesize, None)
+                if selected != -1 and self.seed_only:
+                    self._prune(source_dir, selected[0][numfile:])
+        finally:
+            self.storage_ops.release(endpoints)
+        if selected == -1:
+            self._abort(source_url)
+            return []
+        src_filenames = selected[0][:numfile]
+
+        upload = {
+            'group': group,
+            'source_dir': source_dir,
+            'src_filenames': src_filenames,
+            'checksums': selected[1],
+            'local_file_paths': [],
+            'filenames': [],
+            'adler32s': []
+        }
+        missing = numfile - len(src_filenames)
+        if missing:
+            # generate random files localy
+            _flush_logging_msg(
+                "Preparing {} local random files of size:{}MB".format(
+                    missing, filesize))
+        for i in xrange(missing):
+            filename = "{}.{}".format(FILE_PREFIX, uuid.uuid1())
+            file_path = str(os.path.join(LOCALPATH_TEMP_DIR, filename))
+            with _phase("generate"):
+                digests = self.payload_cache.link(filesize,
+                                                  numfile - missing + i,
+                                                  file_path)
+            upload['local_file_paths'].append(file_path)
+            upload['filenames'].append("{}_{}mb".format(filename, filesize))
+            upload['adler32s'].append(digests['adler32'])
+        return [upload]
+
+    def _prune(self, source_dir, filenames):
+        """
+        Remove the files of a source pool beyond its target
+        """
+        if not filenames:
+            return
+        _flush_logging_msg("Pruning {} surplus files of {}".format(
+            len(filenames), source_dir))
+        _gfal_rm_files(filenames, source_dir)
+        _listing_cache.remove(source_dir, filenames)
+        self.source_pool.remove(source_dir, filenames)
+
+    def _upload(self, upload):
+        """
+        Upload the missing files of a group and release its work units
+        """
+        source_url = upload['group'][0][1].source_url
+        src_filenames = upload['src_filenames']
+        checksums = upload['checksums']
+        if upload['filenames']:
+            # upload files to the source for this group
+            _flush_logging_msg("Uploading files to source")
+            endpoints = [_gfal_endpoint(source_url)]
+            self.storage_ops.acquire(endpoints)
+            try:
+                with _phase("upload"):
+                    results = _gfal_upload_files(upload['local_file_paths'],
+                                                 upload['source_dir'],
+                                                 upload['filenames'],
+                                                 upload['adler32s'])
+            finally:
+                self.storage_ops.release(endpoints)
+                # remove files locally
+                for file in upload['local_file_paths']:
+                    os.remove(file)
+            uploaded = dict(
+                (result['filename'], adler32)
+                for result, adler32 in zip(results, upload['adler32s'])
+                if result['ok'])
+            _listing_cache.add(upload['source_dir'], list(uploaded))
+            self.source_pool.add(upload['source_dir'],
+                                 upload['group'][0][1].filesize, uploaded)
+            if len(uploaded) < len(results):
+                self._abort(source_url)
+                return []
+            src_filenames = src_filenames + upload['filenames']
+            checksums = dict(checksums, **uploaded)
+        if self.seed_only:
+            return []
+
+        units = []
+        for rank, unit in upload['group']:
+            unit = dict(unit._asdict())
+            unit['rank'] = rank
+            unit['src_filenames'] = src_filenames[:unit['numfile']]
+            unit['checksums'] = checksums
+            units.append(unit)
+        return units
+
+    def _submit(self, batch):
+        """
+        Submit the work units of a batch as one FTS job
+
+        Every transfer carries the pair it was planned for in its file
+        metadata, and the job metadata lists all pairs of the job, so the
+        results can be reported per link.
+        """
+        transfers = []
+        links = []
+        purge = {}
+        endpoints = set()
+        for unit in batch:
+            source_url = unit['source_url']
+            dest_url = unit['dest_url']
+            link = {
+                'source': source_url,
+                'destination': dest_url,
+                'filesize': unit['filesize'],
+                'numfile': unit['numfile']
+            }
+            links.append(link)
+            endpoints.update(
+                [_gfal_endpoint(source_url),
+                 _gfal_endpoint(dest_url)])
+            directory = os.path.join(dest_url, self.testing_folder, "dest")
+            for src_filename in unit['src_filenames']:
+                dest_filename = "{}.{}".format(FILE_PREFIX, uuid.uuid1())
+                source_file = os.path.join(source_url, self.testing_folder,
+                                           "src", src_filename)
+                dest_file = os.path.join(directory, dest_filename)
+                transfers.append(
+                    _fts_transfer(source_file, dest_file,
+                                  unit['checksums'].get(src_filename), link))
+                purge.setdefault(directory, []).append(dest_filename)
+        endpoints = sorted(endpoints)
+        self.fts_jobs.acquire(endpoints)
+        try:
+            job_map = self._submit_job(batch, transfers, links, purge,
+                                       endpoints)
+        except Exception:
+            self.fts_jobs.release(endpoints)
+            raise
+        if job_map is None:
+            self.fts_jobs.release(endpoints)
+            return []
+        return [job_map]
+
+    def _submit_job(self, batch, transfers, links, purge, endpoints):
+        """
+        Submit the transfers of a batch and record the job
+
+        Returns:
+            The job map, None if the job was not submitted
+        """
+        metadata = dict(self.metadata)
+        metadata['links'] = links
+        # submit fts transfer
+        _flush_logging_msg('Submitting FTS job: {} transfers, {} links'.format(
+            len(transfers), len(links)))
+        job_id = _fts_submit_transfers(transfers, batch[0]['checksum'],
+                                       self.overwrite, _fts_context(), metadata)
+        if job_id == -1:
+            _flush_logging_msg('Job aborted')
+            return None
+        _flush_logging_msg('FTS job id:{}'.format(job_id))
+
+        job_map = {}
+        job_map['job_id'] = job_id
+        job_map['links'] = links
+        job_map['purge'] = purge
+        job_map['endpoints'] = endpoints
+        job_map['submitted'] = time.time()
+        if self.results is not None:
+            job_map['run_id'] = self.results.run_id
+        if self.checkpoint is not None:
+            # the job is submitted, keep polling it even if not checkpointed
+            try:
+                self.checkpoint.add(job_map)
+            except (IOError, OSError) as e:
+                _flush_logging_msg("Checkpointing failed:{}, job:{}".format(
+                    e, job_id))
+        self.job_map_list.append(job_map)
+        return job_map
+
+    def _job_finished(self, job_map):
+        self.fts_jobs.release(job_map['endpoints'])
+        if self.sampler is None or self.seed_only:
+            return
+        following = []
+        for link in job_map['links']:
+            ranked = self.sampler.finished(link)
+            if ranked is not None:
+                following.append([ranked])
+        # the next units are in flight before this job's are settled
+        self._feed(following)
+        self._settle(len(job_map['links']))
 
 
 # ------------------------------------------------------------------------------
@@ -402,7 +3717,7 @@ def main():
     parser = argparse.ArgumentParser(description="Run FTS Datalake Tests")
 
     parser.add_argument("-i",
-                        required=True,
+                        required=False,
                         dest="conf_file",
                         help="Configuration file")
     parser.add_argument("--cleanup",
@@ -415,193 +3730,324 @@ def main():
                         action='store_true',
                         default=False,
                         help="Exit after cleanup")
+    parser.add_argument("--group-by",
+                        required=False,
+                        choices=["none", "source", "destination"],
+                        default=FTS_JOB_GROUP_BY,
+                        dest="group_by",
+                        help="Submit the transfers of several pairs sharing "
+                        "a source/destination as one FTS job")
+    parser.add_argument("--report",
+                        required=False,
+                        action='store_true',
+                        default=False,
+                        help="Print per-link results of past runs and exit")
+    parser.add_argument("--since",
+                        required=False,
+                        type=float,
+                        default=None,
+                        help="Only report results of the last SINCE hours")
+    parser.add_argument("--dry-run",
+                        required=False,
+                        action='store_true',
+                        default=False,
+                        dest="dry_run",
+                        help="Print the work units of the run and exit")
+    parser.add_argument("--order",
+                        required=False,
+                        choices=["latin", "permutation"],
+                        default=PIPELINE_ORDER,
+                        help="Submission order of the work units: latin "
+                        "spreads every round over all endpoints, "
+                        "permutation keeps the configuration order")
+    parser.add_argument("--simulate",
+                        required=False,
+                        action='store_true',
+                        default=False,
+                        help="Simulate the submission of the work units and "
+                        "print the peak concurrent FTS jobs per endpoint")
+    parser.add_argument("--adaptive",
+                        required=False,
+                        action='store_true',
+                        default=False,
+                        help="Repeat a link only while its throughput is not "
+                        "stable yet or it failed; links go on independently "
+                        "(not with --group-by)")
+    parser.add_argument("--budget",
+                        required=False,
+                        type=int,
+                        default=None,
+                        help="MB an adaptive run may transfer (split among "
+                        "--processes), 0 for no limit")
+    parser.add_argument("--seed-only",
+                        required=False,
+                        action='store_true',
+                        default=False,
+                        dest="seed_only",
+                        help="Top up the source files of every source and "
+                        "exit without submitting transfers")
+    parser.add_argument("--seed-hub",
+                        required=False,
+                        action='append',
+                        default=[],
+                        dest="seed_hubs",
+                        metavar="URL",
+                        help="Seed the sources of the hub's protocol with "
+                        "FTS copies from this source (protocol://endpoint), "
+                        "uploading files only to the hub; may be repeated")
+    parser.add_argument("--resume",
+                        required=False,
+                        action='store_true',
+                        default=False,
+                        help="Poll and purge the unfinished jobs of an "
+                        "interrupted run and exit")
+    parser.add_argument("--shard",
+                        required=False,
+                        type=_parse_shard,
+                        default=None,
+                        help="Only run the work units of shard i out of N "
+                        "(i/N, 0-based)")
+    parser.add_argument("--processes",
+                        required=False,
+                        type=int,
+                        default=1,
+                        help="Split the run into shards run by this many "
+                        "local worker processes")
+    parser.add_argument("--run-id",
+                        required=False,
+                        default=None,
+                        dest="run_id",
+                        help="Identifier of the run in the results store, "
+                        "shared by all of its shards")
+    parser.add_argument("--skip-setup",
+                        required=False,
+                        action='store_true',
+                        default=False,
+                        dest="skip_setup",
+                        help="Do not set up the endpoints and seed hubs "
+                        "(done by the launcher of a shard)")
+    parser.add_argument("--problematic",
+                        required=False,
+                        nargs="*",
+                        default=[],
+                        metavar="ENDPOINT",
+                        help="Endpoints (without protocol) found "
+                        "problematic by the setup, with --skip-setup")
+    parser.add_argument("--merge-results",
+                        required=False,
+                        nargs="+",
+                        default=None,
+                        dest="merge_results",
+                        metavar="DB",
+                        help="Merge the results stores of shards run "
+                        "elsewhere into the local one and exit")
+    parser.add_argument("--setup-workers",
+                        required=False,
+                        type=int,
+                        default=GFAL2_SETUP_WORKERS,
+                        dest="setup_workers",
+                        help="Number of endpoints set up concurrently")
 
     arg = parser.parse_args()
+    if arg.budget is not None and not arg.adaptive:
+        parser.error("--budget only applies to --adaptive runs")
+    budget = ADAPTIVE_BUDGET_MB if arg.budget is None else arg.budget
+    if arg.adaptive and arg.group_by != "none":
+        parser.error("--adaptive submits every link on its own, "
+                     "--group-by must be none")
+    _setup_logging()
+
+    if arg.report:
+        since = None
+        if arg.since is not None:
+            since = time.time() - arg.since * 3600
+        _print_link_report(_ResultsStore(), since)
+        return
+    if arg.merge_results:
+        results = _ResultsStore()
+        for results_db in arg.merge_results:
+            _flush_logging_msg("Merged {} results of {}".format(
+                results.merge(results_db), results_db))
+        return
+    run_id = arg.run_id or str(uuid.uuid1())
+    launcher = arg.processes > 1 and arg.shard is None and not (arg.dry_run or
+                                                                arg.simulate)
+    if launcher and arg.resume:
+        _export_metrics()
+        if _run_shards(_strip_option(sys.argv[1:], "--processes"),
+                       arg.processes, run_id):
+            sys.exit(1)
+        return
+    if arg.resume:
+        _export_metrics()
+        checkpoint = _Checkpoint(_shard_path(CHECKPOINT, arg.shard))
+        job_map_list = checkpoint.job_maps()
+        if not job_map_list:
+            _flush_logging_msg("No unfinished FTS jobs to resume")
+            return
+        _flush_logging_msg("Resuming {} unfinished FTS jobs".format(
+            len(job_map_list)))
+        _fts_wait_jobs(_fts_context(),
+                       job_map_list,
+                       results=_ResultsStore(),
+                       checkpoint=checkpoint)
+        _log_phase_times()
+        _flush_logging_msg("Resume DONE, program is going to exit now!")
+        return
+    if not arg.conf_file:
+        parser.error("a configuration file (-i) is required")
+
     conf_file = str(arg.conf_file)
     cleanup = arg.cleanup
     exit = arg.exit
+    setup_workers = arg.setup_workers
+    group_by = arg.group_by
 
     # open configuration file to get test details
     with open(conf_file) as json_file:
-        data = json.load(json_file)
-
-        # assign json variables
-        protocol_map = data['protocols']
-        num_of_files_list = data['num_of_files']
-        filesize_list = data['filesizes']
-        num_of_jobs = data['num_of_jobs']
-        testing_folder = data['testing_folder']
-        checksum = data["checksum"]
-        overwrite = data["overwrite"]
-        metadata = data['metadata']
-
-        # figure out the unique endpoints from the configuration
-        endpoints = []
-        endpoint_tlist = []
-        for protocol in protocol_map:
-            protocol_endpoints = protocol_map[protocol]
-            for endpoint in protocol_endpoints:
-                # example: endpoint = door05.pic.es:8452//rucio/pic_dcache
-                endpoint_t = endpoint.split(":", 1)[0]
-                # example: endpoint_t = door05.pic.es
-                endpoint_e = re.split('[0-9]*', endpoint.split(":", 1)[1], 1)[1]
-                # example: endpoint_e = //rucio/pic_dcache
-                endpoint_ft = endpoint_t + endpoint_e
-                if endpoint_ft not in endpoint_tlist:
-                    endpoint_tlist.append(endpoint_ft)
-                    endpoints.append("{}://{}".format(protocol, endpoint))
-        del endpoint_tlist
-
-        # setup folders at the testing endpoints if needed
-        _flush_logging_msg("Setting up folders at endpoints")
-        prob_endpoints = _gfal_setup_folders(endpoints, testing_folder, cleanup)
-
-        # we have some problematic endpoints
-        if prob_endpoints:
-            _flush_logging_msg(
-                "Problematic endpoints (will not be tested): {})".format(
-                    prob_endpoints))
-
-        # the script is used as a setup script so do not perform testing
-        if exit:
-            sys.exit(1)
+        try:
+            plan = _compile_plan(json.load(json_file))
+        except ValueError as e:
+            parser.error("invalid configuration {}: {}".format(conf_file, e))
+
+        sources = set(unit.source_url for unit in plan.units)
+        hubs = {}
+        for hub_url in arg.seed_hubs:
+            if hub_url not in sources:
+                parser.error("seed hub {} is not a source of {}".format(
+                    hub_url, conf_file))
+            hubs[hub_url.split("://", 1)[0]] = hub_url
+
+        if arg.dry_run:
+            _print_plan(
+                plan,
+                _order_units(_select_units(plan.units, [], arg.shard),
+                             arg.order))
+            return
+        if arg.simulate:
+            throughput = _ResultsStore().link_throughput(time.time() -
+                                                         FTS_POLL_HISTORY *
+                                                         3600)
+            _print_simulation(
+                _simulate_schedule(
+                    _order_units(_select_units(plan.units, [], arg.shard),
+                                 arg.order), group_by, FTS_JOB_MAX_TRANSFERS,
+                    throughput), arg.order)
+            return
+        _export_metrics()
+
+        if arg.skip_setup:
+            prob_endpoints = arg.problematic
+        else:
+            # setup folders at the testing endpoints if needed
+            _flush_logging_msg("Setting up folders at endpoints")
+            with _phase("setup"):
+                health = _HealthCache()
+                prob_endpoints = _gfal_setup_folders(plan.endpoints,
+                                                     plan.testing_folder,
+                                                     cleanup,
+                                                     setup_workers,
+                                                     health=health,
+                                                     deadlines=plan.deadlines)
+                health.save()
+
+            # we have some problematic endpoints
+            if prob_endpoints:
+                _flush_logging_msg(
+                    "Problematic endpoints (will not be tested): {})".format(
+                        prob_endpoints))
+
+            # the script is used as a setup script so do not perform testing
+            if exit:
+                sys.exit(1)
+
+        for protocol, hub_url in list(hubs.items()):
+            if hub_url.split("://", 1)[1] in prob_endpoints:
+                _flush_logging_msg(
+                    "Seed hub {} is problematic, uploading to its sources "
+                    "instead".format(hub_url))
+                del hubs[protocol]
+
+        # endpoints and seed hubs are set up once, here, for all the shards
+        if launcher:
+            if hubs:
+                payload_cache = _PayloadCache(PAYLOAD_CACHE_DIR)
+                _Pipeline(plan.testing_folder, plan.overwrite, plan.metadata,
+                          payload_cache).top_up_hubs(
+                              _select_units(plan.units, prob_endpoints), hubs)
+                payload_cache.clear()
+            start = time.time()
+            argv = _strip_option(sys.argv[1:], "--processes")
+            if arg.adaptive and budget:
+                argv = _strip_option(argv, "--budget") + [
+                    "--budget",
+                    str(max(1, budget // arg.processes))
+                ]
+            argv.append("--skip-setup")
+            if prob_endpoints:
+                argv += ["--problematic"] + list(prob_endpoints)
+            failed = _run_shards(argv, arg.processes, run_id)
+            _print_link_report(_ResultsStore(), start)
+            if failed:
+                sys.exit(1)
+            return
+
+        # generated files are reused by every pair of the run
+        payload_cache = _PayloadCache(_shard_path(PAYLOAD_CACHE_DIR, arg.shard))
+        units = _order_units(
+            _select_units(plan.units, prob_endpoints, arg.shard), arg.order)
+
+        # only bring the source pools to their target, no transfers
+        if arg.seed_only:
+            _flush_logging_msg("Seeding the source pools of {} FTS jobs".format(
+                len(units)))
+            pipeline = _Pipeline(plan.testing_folder, plan.overwrite,
+                                 plan.metadata, payload_cache)
+            if hubs:
+                pipeline.replicate(units, hubs, top_up=not arg.skip_setup)
+            pipeline.run(units, seed_only=True)
+            payload_cache.clear()
+            _log_phase_times()
+            _flush_logging_msg("Seeding DONE, program is going to exit now!")
+            return
 
         # ----------------------------------------------------------------------
 
         # authenticate @ FTS endpoint
-        # https://gitlab.cern.ch/fts/fts-rest/-/blob/develop/src/fts3/rest/client/context.py#L148
         _flush_logging_msg('Authenticating at {}'.format(FTS_ENDPOINT))
-        context = fts3.Context(FTS_ENDPOINT, verify=True)
-
-        # list that holds a dictionary per each job
-        # this is later used to poll for the jobs until they finish
-        job_map_list = []
+        _fts_context().get("/whoami")
+        _fts_delegate()
+
+        _flush_logging_msg("Running {} FTS jobs".format(len(units)))
+        results = _ResultsStore(run_id=run_id)
+        checkpoint = _Checkpoint(_shard_path(CHECKPOINT, arg.shard))
+        leftover = checkpoint.job_maps()
+        if leftover:
+            _flush_logging_msg(
+                "{} FTS jobs of an interrupted run are left in {}, "
+                "run with --resume to purge them".format(
+                    len(leftover), checkpoint.path))
+        sampler = None
+        if arg.adaptive:
+            sampler = _AdaptiveSampler(units, results, budget)
+        pipeline = _Pipeline(plan.testing_folder,
+                             plan.overwrite,
+                             plan.metadata,
+                             payload_cache,
+                             group_by,
+                             results=results,
+                             checkpoint=checkpoint,
+                             sampler=sampler)
+        if hubs:
+            pipeline.replicate(units, hubs, top_up=not arg.skip_setup)
+        pipeline.run(units)
+        if sampler is not None:
+            _flush_logging_msg(
+                "Adaptive run: {} FTS jobs skipped, {} MB transferred".format(
+                    sampler.skipped, sampler.spent_mb))
+        payload_cache.clear()
 
-        # for every job
-        for _ in xrange(num_of_jobs):
-            # for every protocol to be checked
-            for protocol in protocol_map:
-                # get endpoints
-                protocol_endpoints = protocol_map[protocol]
-                # create unique pairs of 2s (source destionation)
-                endpnt_pairs = itertools.permutations(protocol_endpoints, 2)
-                # for every pair
-                for endpnt_pair in endpnt_pairs:
-                    # ad-hoc temp solution for lapp-webdav - remove checksum
-                    if endpnt_pair[0] == "lapp-esc02.in2p3.fr:8001/webdav":
-                        checksum = "none"
-                    if endpnt_pair[1] == "lapp-esc02.in2p3.fr:8001/webdav":
-                        checksum = "none"
-                    # --
-                    abort_source = False
-                    source_url = "{}://{}".format(protocol, endpnt_pair[0])
-                    dest_url = "{}://{}".format(protocol, endpnt_pair[1])
-                    # if the source endpoint is faulty, abort this run
-                    if endpnt_pair[0] in prob_endpoints:
-                        _flush_logging_msg("Aborting run for source: {}".format(
-                            endpnt_pair[0]))
-                        continue
-                    _flush_logging_msg(
-                        ">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
-                    _flush_logging_msg("Source: {}".format(source_url))
-                    _flush_logging_msg("Destination: {}".format(dest_url))
-                    # for every filesize combination
-                    for filesize in filesize_list:
-                        if abort_source:
-                            _flush_logging_msg(
-                                "Aborting run for source: {}".format(
-                                    source_url))
-                            break
-
-                        # for every files per job combination
-                        for numfile in num_of_files_list:
-
-                            # configure destination filenames
-                            local_file_paths = []
-                            dest_filenames = []
-                            for nfile in xrange(numfile):
-                                random_suffix = str(uuid.uuid1())
-                                random_filename = "{}.{}".format(
-                                    FILE_PREFIX, random_suffix)
-                                dest_filenames.append(random_filename)
-                                file_path = os.path.join(
-                                    LOCALPATH_TEMP_DIR, random_filename)
-                                local_file_paths.append(str(file_path))
-
-                            source_dir = os.path.join(source_url,
-                                                      testing_folder, "src")
-
-                            # check if source has adequate number of files of
-                            # the desired filesize
-                            _flush_logging_msg(
-                                "Checking source for {} existing {}MB files".
-                                format(numfile, filesize))
-                            src_filenames = _gfal_check_files(
-                                source_dir, filesize, numfile)
-
-                            if src_filenames == -1:
-                                abort_source = True
-                                _flush_logging_msg(
-                                    "Aborting run for source: {}".format(
-                                        source_url))
-                                break
-
-                            remove_local_files = False
-                            if not src_filenames:
-                                remove_local_files = True
-                                for filename in dest_filenames:
-                                    src_filename = "{}_{}mb".format(
-                                        filename, filesize)
-                                    src_filenames.append(src_filename)
-
-                                # generate random files localy
-                                _flush_logging_msg(
-                                    "Locally generating {} random files of size:{}MB"
-                                    .format(numfile, filesize))
-                                for file_path in local_file_paths:
-                                    with open(file_path, 'wb') as fout:
-                                        fout.write(os.urandom(filesize * MB))
-
-                                # upload files to the source for this job
-                                _flush_logging_msg("Uploading files to source")
-                                rcode = _gfal_upload_files(
-                                    local_file_paths, source_dir, src_filenames)
-                                if rcode == -1:
-                                    abort_source = True
-                                    _flush_logging_msg(
-                                        "Aborting run for source: {}".format(
-                                            source_url))
-                                    break
-
-                            # submit fts transfer
-                            _flush_logging_msg('Submitting FTS job')
-                            job_id = _fts_submit_job(source_url, dest_url,
-                                                     src_filenames,
-                                                     dest_filenames, checksum,
-                                                     overwrite, testing_folder,
-                                                     context, metadata)
-                            if job_id == -1:
-                                _flush_logging_msg('Job aborted')
-                                continue
-                            _flush_logging_msg('FTS job id:{}'.format(job_id))
-
-                            job_map = {}
-                            job_map['job_id'] = job_id
-                            job_map['directory'] = os.path.join(
-                                dest_url, testing_folder, "dest")
-                            job_map['files_to_purge'] = dest_filenames
-                            job_map_list.append(job_map)
-
-                            if remove_local_files:
-                                # remove files locally
-                                _flush_logging_msg(
-                                    "Removing files from LOCALPATH: {}".format(
-                                        LOCALPATH_TEMP_DIR))
-                                for file in local_file_paths:
-                                    os.remove(file)
-
-        _flush_logging_msg(">>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>")
-        _fts_wait_jobs(context, job_map_list)
+        _log_phase_times()
         _flush_logging_msg("Testing DONE, program is going to exit now!")
 
 